@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Enrichment throughput benchmark.
+
+Runs enrichment.enrich_dataset end to end against a local OpenAI-compatible
+stub server, with sheets stubbed out, and reports rows/s, LLM calls per row
+and p50/p99 per-row latency for each dataset size and concurrency setting.
+No OpenAI key or sheet access is needed.
+
+    python bench_enrichment.py --rows 1000,10000 --concurrency 4,16,64
+    python bench_enrichment.py --latency-ms 300 --error-rate 0.02 --rate-limit-rate 0.05
+    python bench_enrichment.py --server-rpm 3000 --batch-rows 1,20 --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import zlib
+
+import pandas as pd
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import enrichment
+import labelcache
+import llm
+
+ROW_ID_RE = re.compile(r"\[row_id (\d+)\]")
+
+WORDS = ("late delayed friendly rude clean dirty comfortable cramped cheap expensive "
+         "quick slow helpful lost refund upgrade seat meal crew gate").split()
+
+
+class MockServerState:
+    """Knobs and counters of the stub server; shared with the request handlers."""
+
+    def __init__(self, latency_ms, jitter, error_rate, rate_limit_rate, retry_after_ms, server_rpm):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.server_rpm = server_rpm
+        self.window = []  # request times within the last minute, for server_rpm
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def over_limit(self):
+        if not self.server_rpm:
+            return False
+        now = time.monotonic()
+        self.window = [t for t in self.window if now - t < 60]
+        if len(self.window) >= self.server_rpm:
+            return True
+        self.window.append(now)
+        return False
+
+
+def fake_arguments(function, content):
+    """Arguments that satisfy a classify function's schema for the rows in content."""
+    parameters = function["parameters"]
+    if "results" in parameters.get("properties", {}):
+        item_schema = parameters["properties"]["results"]["items"]
+        return {"results": [
+            {"row_id": int(m.group(1)), **fake_labels(item_schema, content[m.end():].split("\n", 1)[0])}
+            for m in ROW_ID_RE.finditer(content)
+        ]}
+    return fake_labels(parameters, content)
+
+
+def fake_labels(schema, text):
+    labels = {}
+    for name, prop in schema["properties"].items():
+        if name == "row_id":
+            continue
+        values = prop.get("enum")
+        # Deterministic per row, so repeated runs agree
+        labels[name] = values[zlib.crc32(text.encode()) % len(values)] if values else text[:20]
+    return labels
+
+
+def create_mock_app(state):
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        state.requests += 1
+        delay = state.latency_ms / 1000 * random.uniform(1 - state.jitter, 1 + state.jitter)
+        await asyncio.sleep(max(0.0, delay))
+        if state.over_limit() or random.random() < state.rate_limit_rate:
+            state.rate_limited += 1
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after-ms": str(state.retry_after_ms)},
+                content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            )
+        if random.random() < state.error_rate:
+            state.errors += 1
+            return JSONResponse(status_code=500, content={"error": {"message": "Mock server error", "type": "server_error"}})
+        content = body["messages"][-1]["content"]
+        message = {"role": "assistant", "content": None}
+        if body.get("functions"):
+            function = body["functions"][0]
+            message["function_call"] = {"name": function["name"], "arguments": json.dumps(fake_arguments(function, content))}
+        else:
+            message["content"] = "Mock completion."
+        prompt_tokens = enrichment.estimate_tokens(json.dumps(body))
+        completion_tokens = enrichment.estimate_tokens(json.dumps(message))
+        return {
+            "id": f"chatcmpl-mock{state.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "function_call" if body.get("functions") else "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    return app
+
+
+def start_mock_server(state):
+    """Serve the stub on a free local port from a daemon thread; returns its base URL."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_mock_app(state), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+class NullSheetWriter:
+    """Stands in for sheets.BufferedSheetWriter; keeps nothing but a row count."""
+
+    def __init__(self, spreadsheet_id, sheet_name, on_flush=None, **kwargs):
+        self.on_flush = on_flush
+        self.rows = 0
+
+    def write(self, rows):
+        self.rows += len(rows)
+        if self.on_flush is not None:
+            self.on_flush(self.rows)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def null_create_and_upload_df(df, title, sheet_name="Sheet1", **kwargs):
+    return {"spreadsheetId": f"bench-{title}", "spreadsheetUrl": None, "filename": f"{title}.csv"}
+
+
+def make_dataset(rows, seed=0):
+    rng = random.Random(seed)
+    return pd.DataFrame({
+        "feedback": [" ".join(rng.choices(WORDS, k=rng.randint(6, 24))) for _ in range(rows)],
+        "rating": [rng.randint(1, 5) for _ in range(rows)],
+    })
+
+
+def time_calls(latencies):
+    """Wrap the Generator's calls so each row gets the latency of the call that labelled it."""
+    batch_enrich = enrichment.Generator.abatch_enrich
+    single_enrich = enrichment.Generator.astructured_enrich
+
+    async def timed_batch(self, row_contexts, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await batch_enrich(self, row_contexts, *args, **kwargs)
+        finally:
+            latencies.extend([time.monotonic() - started] * len(row_contexts))
+
+    async def timed_single(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await single_enrich(self, *args, **kwargs)
+        finally:
+            latencies.append(time.monotonic() - started)
+
+    enrichment.Generator.abatch_enrich = timed_batch
+    enrichment.Generator.astructured_enrich = timed_single
+
+
+def run_case(state, df, concurrency, batch_rows, rpm, tpm, cache_dir, latencies):
+    enrichment.ENRICHMENT_CONCURRENCY = concurrency
+    enrichment.ENRICHMENT_BATCH_MAX_ROWS = batch_rows
+    enrichment.ENRICHMENT_REQUESTS_PER_MINUTE = rpm
+    enrichment.ENRICHMENT_TOKENS_PER_MINUTE = tpm
+    # A fresh label cache and gateway per case, so no case reuses another's labels or metrics
+    labelcache.label_cache.path = os.path.join(cache_dir, f"labels-{time.monotonic_ns()}.sqlite")
+    labelcache.label_cache.conn = None
+    llm.gateway = llm.LLMGateway()
+    state.reset()
+    latencies.clear()
+    started = time.monotonic()
+    enrichment.enrich_dataset(
+        df.copy(), "Classify the sentiment of this airline feedback: {context}", "sentiment",
+        ["positive", "neutral", "negative"], title="bench",
+    )
+    elapsed = time.monotonic() - started
+    gateway_stats = llm.gateway.stats()["calls"].get("enrichment", {})
+    llm.gateway.close()
+    rows = len(df)
+    return {
+        "rows": rows,
+        "concurrency": concurrency,
+        "batch_rows": batch_rows,
+        "seconds": round(elapsed, 2),
+        "rows_per_second": round(rows / elapsed, 1),
+        "calls_per_row": round(state.requests / rows, 3),
+        "server_requests": state.requests,
+        "rate_limited": state.rate_limited,
+        "server_errors": state.errors,
+        "row_p50_ms": round(pd.Series(latencies).quantile(0.5) * 1000, 1) if latencies else None,
+        "row_p99_ms": round(pd.Series(latencies).quantile(0.99) * 1000, 1) if latencies else None,
+        "call_p99_ms": gateway_stats.get("p99_ms"),
+    }
+
+
+def parse_ints(text):
+    return [int(part) for part in text.split(",") if part]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enrichment throughput benchmark against a local mock LLM")
+    parser.add_argument("--rows", default="1000,10000", help="Dataset sizes, comma separated")
+    parser.add_argument("--concurrency", default="4,16,64", help="ENRICHMENT_CONCURRENCY values, comma separated")
+    parser.add_argument("--batch-rows", default=str(enrichment.ENRICHMENT_BATCH_MAX_ROWS),
+                        help="ENRICHMENT_BATCH_MAX_ROWS values, comma separated (1 = one row per call)")
+    parser.add_argument("--latency-ms", type=float, default=200, help="Mean mock response time")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Response time spread, as a fraction of the mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200, help="retry-after-ms sent with each 429")
+    parser.add_argument("--server-rpm", type=int, default=0, help="Requests per minute before the mock returns 429s (0 = no limit)")
+    parser.add_argument("--rpm", type=int, default=1_000_000, help="Client-side ENRICHMENT_REQUESTS_PER_MINUTE")
+    parser.add_argument("--tpm", type=int, default=1_000_000_000, help="Client-side ENRICHMENT_TOKENS_PER_MINUTE")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    state = MockServerState(args.latency_ms, args.jitter, args.error_rate, args.rate_limit_rate,
+                            args.retry_after_ms, args.server_rpm)
+    os.environ["OPENAI_BASE_URL"] = start_mock_server(state)
+    os.environ["OPENAI_API_KEY"] = "mock"
+    enrichment.create_and_upload_df = null_create_and_upload_df
+    enrichment.BufferedSheetWriter = NullSheetWriter
+    latencies = []
+    time_calls(latencies)
+
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for rows in parse_ints(args.rows):
+            df = make_dataset(rows)
+            for batch_rows in parse_ints(args.batch_rows):
+                for concurrency in parse_ints(args.concurrency):
+                    result = run_case(state, df, concurrency, batch_rows, args.rpm, args.tpm, cache_dir, latencies)
+                    results.append(result)
+                    print(f"[bench] {json.dumps(result)}", flush=True)
+
+    columns = ["rows", "concurrency", "batch_rows", "rows_per_second", "calls_per_row",
+               "rate_limited", "server_errors", "row_p50_ms", "row_p99_ms"]
+    print()
+    print(pd.DataFrame(results)[columns].to_string(index=False))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,5 @@
+import asyncio
 import os
-import pandas as pd
-import io
-import contextlib
 
 from dotenv import load_dotenv
 from loguru import logger
@@ -21,16 +19,16 @@ from pipecat.processors.transcript_processor import TranscriptProcessor
 from broadcast import broadcaster
 from pipecat.adapters.schemas.tools_schema import ToolsSchema
 from pipecat.services.llm_service import FunctionCallParams
-from openai import OpenAI
+import llm
 import sheets
-import enrichment
-import matplotlib.pyplot as plt
-import base64
-import io
+import jobs
+import datasets
+import profiling
+import sandbox
+import results
+import charts
 load_dotenv(override=True)
 
-client = OpenAI()
-
 chat_histories = {}
 
 def add_to_chat_history(session_id, role, content):
@@ -67,7 +65,8 @@ async def summarize_chat_history(session_id: str, report_url: str):
     messages.append({"role": "user", "content": f"Here is the conversation transcript:\n\n{transcript}\n\nPlease provide the summary."})
         
     try:
-        response =  client.chat.completions.create(
+        response = await llm.gateway.chat(
+            tag="summary",
             model="gpt-4.1-mini",
             messages=messages
         )
@@ -78,142 +77,159 @@ async def summarize_chat_history(session_id: str, report_url: str):
 
     return summary
 
+def describe_column(col):
+    details = [col["dtype"]]
+    if "null_count" in col:
+        details.append(f"{col['null_count']} nulls")
+    if "cardinality" in col:
+        details.append(f"{col['cardinality']} distinct")
+    return f"{col['name']} ({', '.join(details)})"
+
 def get_df_column_info(session_id):
-    try:
-        df = pd.read_csv(f"data/{session_id}.csv")
-    except Exception:
-        try:
-            df = pd.read_csv(f"{session_id}.csv")
-        except Exception:
-            df = pd.read_csv("airline.csv")
-    col_info = ", ".join(f"{c} ({str(dt)})" for c, dt in zip(df.columns, df.dtypes))
-    return f"The dataset columns are: {col_info}. The dataset is airline customer satisfaction"
+    # Read the sidecar written at upload; only parse the data if it is missing.
+    # Blocking either way (profiling may extend work too); run it in a thread.
+    schema = datasets.read_schema(session_id)
+    if schema is None:
+        df = datasets.load_dataset(session_id)
+        schema = {
+            "row_count": len(df),
+            "columns": [{"name": str(c), "dtype": str(dt)} for c, dt in zip(df.columns, df.dtypes)],
+        }
+    columns = schema["columns"]
+    manifest = datasets.read_columns_manifest(session_id)
+    if manifest is not None:
+        # Columns added by enrichment replace uploaded ones of the same name
+        appended = [col for entry in manifest["entries"] for col in entry["columns"]]
+        names = {col["name"] for col in appended}
+        columns = [col for col in columns if col["name"] not in names] + appended
+    col_info = ", ".join(describe_column(col) for col in columns)
+    info = f"The dataset has {schema['row_count']} rows. The dataset columns are: {col_info}. The dataset is airline customer satisfaction"
+    # Summary statistics are precomputed after upload; no need to recompute them with code
+    profile = profiling.get_session_profile(session_id)
+    if profile is not None:
+        info += f"\nPrecomputed column statistics:\n{profiling.summarize_for_prompt(profile)}"
+    return info
 
 ###################### TOOLS ######################
+def lookup_dataset_profile(session_id):
+    # The tool is registered under the function's name, which SYSTEM_PROMPT refers to
+    async def lookup_dataset_profile(params: FunctionCallParams, column: str = ""):
+        """Look up precomputed statistics of the dataset without running code.
+
+        Returns count, nulls, distinct values, top values and, for numeric
+        columns, mean, std, min, max, quantiles and a histogram.
+
+        Args:
+            column: Column to look up. Leave empty for an overview of all columns.
+        """
+        profile = await asyncio.to_thread(profiling.get_session_profile, session_id)
+        if profile is None:
+            result = "The dataset profile is not ready yet, use execute_dataframe_code instead."
+        elif column:
+            col = profiling.find_column(profile, column)
+            result = col if col is not None else f"Unknown column: {column}"
+        else:
+            result = profiling.summarize_for_prompt(profile, max_columns=len(profile["columns"]))
+        await params.result_callback({"result": result})
+    return lookup_dataset_profile
+
 def enrich_dataset(session_id):
     async def _enrich_dataset(params: FunctionCallParams, classification_prompt:str,
                               output_col_name: str,
                               document_title: str,
-                              possible_values: list[str]):
-        df = pd.read_csv(f"data/{session_id}.csv")
-        future = enrichment.run_enrichment_in_background(
-            pd_df=df,
-            prompt=classification_prompt,
-            col_name=output_col_name,
-            possible_values=possible_values,
-            title=document_title,
-            session_id=session_id
-        )
-        await params.result_callback({"result": "Enrichment initiated, and deferred to background task"})
+                              possible_values: list[str],
+                              context_columns: list[str] = None,
+                              additional_targets: dict[str, list[str]] = None,
+                              hybrid: bool = False):
+        # Off the loop: without the columnar copy yet, this is a full CSV parse
+        df = await asyncio.to_thread(datasets.load_dataset, session_id)
+        # Unknown names are dropped; with none left, enrichment infers them from the prompt
+        columns = [col for col in context_columns or [] if col in df.columns] or None
+        col_name, values = output_col_name, possible_values
+        if additional_targets:
+            # All targets come from one call per row or batch
+            col_name = [output_col_name, *additional_targets]
+            values = {output_col_name: possible_values, **additional_targets}
+        job = jobs.job_manager.submit(session_id, df, {
+            "prompt": classification_prompt,
+            "col_name": col_name,
+            "possible_values": values,
+            "title": document_title,
+            "context_columns": columns,
+            "hybrid": hybrid,
+        })
+        await params.result_callback({
+            "result": f"Enrichment initiated as background job {job.job_id} over {job.total_rows} rows. "
+                      f"Once it completes, its columns are part of df for execute_dataframe_code."
+        })
     return _enrich_dataset
 
 # Create a function factory that captures the session_id
 def create_execute_dataframe_code(session_id):
     async def execute_dataframe_code(params: FunctionCallParams, code: str,
                                      anaylsis_title: str = "", upload_to_google_docs: bool=False):
-        import traceback
-
         def format_exception(e):
             return f"{type(e).__name__}: {e}"
 
-        result = ""
-        try:
-            df = None
-            loaded = False
+        # Repeated questions reuse the earlier outcome, chart included
+        cache_key = results.result_cache.make_key(
+            datasets.dataset_version(session_id), code, upload_to_google_docs=upload_to_google_docs
+        )
+        outcome = results.result_cache.get(cache_key)
+        if outcome is not None:
+            print(f"Result cache hit ({results.result_cache.stats()})", flush=True)
+        else:
+            # Code execution step, in a worker process so slow code never blocks
+            # the audio pipeline or other sessions
             try:
-                df = pd.read_csv(f"data/{session_id}.csv")
-                print(f"Loaded dataset from data/{session_id}.csv", flush=True)
-                loaded = True
+                outcome = await sandbox.code_pool.run_code(session_id, code, upload_to_google_docs)
             except Exception as e:
-                print(f"no data found for session id {session_id} in data folder. error {e}", flush=True)
-                try:
-                    df = pd.read_csv(f"{session_id}.csv")
-                    print(f"Loaded dataset from {session_id}.csv", flush=True)
-                    loaded = True
-                except Exception as e2:
-                    print(f"no data found for session id {session_id} in current directory. error {e2}", flush=True)
-                    try:
-                        df = pd.read_csv("airline.csv")
-                        print("Using default airline dataset", flush=True)
-                        loaded = True
-                    except Exception as e3:
-                        err_msg = (f"Failed to load any dataset: {format_exception(e3)}")
-                        print(err_msg, flush=True)
-                        result = err_msg
-            if not loaded:
-                await params.result_callback({"result": result})
-                return
-        except Exception as e:
-            err_msg = f"Error loading dataset: {format_exception(e)}"
-            print(err_msg, flush=True)
-            result = err_msg
-            await params.result_callback({"result": result})
-            return
-
-        # Safe dict for local scope
-        safe_locals = {"df": df, "pd": pd}
-        output = io.StringIO()
-        result_to_upload = None
-
-        # Code execution step
-        try:
+                outcome = {"result": f"Internal error while running code: {format_exception(e)}",
+                           "upload": None, "error": True, "images": [], "full_result": None, "result_ref": None, "cpu_seconds": None, "peak_memory_mb": None}
+                print(outcome["result"], flush=True)
+
+            # Store each chart once by content hash; only its URL travels on
+            outcome["images"] = [
+                await asyncio.to_thread(charts.store_image, data, ext) for data, ext in outcome["images"]
+            ]
+
+            if not outcome["error"]:
+                results.result_cache.put(cache_key, outcome)
+
+        result = outcome["result"]
+        result_to_upload = outcome["upload"]
+        if outcome["full_result"] is not None:
+            results.full_result_store.put(outcome["result_ref"], outcome["full_result"])
+        usage = {"cpu_seconds": outcome["cpu_seconds"], "peak_memory_mb": outcome["peak_memory_mb"]}
+
+        # Image result step: listeners fetch the chart from its URL
+        for image_url in outcome["images"]:
             try:
-                compiled = compile(code, "<string>", "eval")
-                try:
-                    value = eval(compiled, {}, safe_locals)
-                    result = str(value)
-                    if upload_to_google_docs and isinstance(value, pd.DataFrame):
-                        result_to_upload = value
-                except Exception as eval_err:
-                    result = f"Error during evaluation: {format_exception(eval_err)}"
-                    print(result, flush=True)
-            except SyntaxError:
-                before_vars = set(safe_locals.keys())
-                try:
-                    with contextlib.redirect_stdout(output):
-                        exec(code, {}, safe_locals)
-                    result = output.getvalue() or "Code executed, but did not return or print anything."
-                    after_vars = set(safe_locals.keys())
-                    if upload_to_google_docs:
-                        new_vars = after_vars - before_vars
-                        df_candidates = [safe_locals[k] for k in new_vars if isinstance(safe_locals[k], pd.DataFrame)]
-                        if not df_candidates:
-                            df_candidates = [
-                                safe_locals[k] for k in after_vars
-                                if isinstance(safe_locals[k], pd.DataFrame) and 
-                                (k not in before_vars or id(safe_locals[k]) != id(safe_locals.get(k)))
-                            ]
-                        if df_candidates:
-                            result_to_upload = df_candidates[-1]
-                except Exception as exec_err:
-                    tb = traceback.format_exc(limit=3)
-                    result = f"Error during execution: {format_exception(exec_err)}\n{tb}"
-                    print(result, flush=True)
-        except Exception as e:
-            tb = traceback.format_exc(limit=3)
-            # If something really weird happened
-            result = f"Internal error during code compile step: {format_exception(e)}\n{tb}"
-            print(result, flush=True)
-
-        # Image result step
-        image_path = 'analysis.png'
-        try:
-            if os.path.exists(image_path):
-                with open(image_path, 'rb') as f:
-                    image_base64 = base64.b64encode(f.read()).decode('utf-8')
-                os.remove(image_path)
-                try:
-                    await broadcaster.push(f"image: {image_base64}")
-                except Exception as bce:
-                    print(f"Error in broadcaster image push: {format_exception(bce)}", flush=True)
-        except Exception as e:
-            print(f"Error handling image result: {format_exception(e)}", flush=True)
+                await broadcaster.push(f"image: {image_url}")
+            except Exception as bce:
+                print(f"Error in broadcaster image push: {format_exception(bce)}", flush=True)
 
         # Google Sheets upload step (optional)
         if upload_to_google_docs and result_to_upload is not None:
+            loop = asyncio.get_running_loop()
+
+            def report_upload(rows_done, total_rows):
+                # Called from the upload threads
+                asyncio.run_coroutine_threadsafe(
+                    broadcaster.push(f"data: Uploaded {rows_done}/{total_rows} rows to Google Sheets"), loop
+                )
+
             try:
-                sheets.create_and_upload_df(result_to_upload, anaylsis_title)
-                result += "\n\nDataFrame uploaded to Google Sheets."
+                # The sheet is created before returning; large frames keep uploading in the background
+                upload = await asyncio.to_thread(
+                    sheets.create_and_upload_df, result_to_upload, anaylsis_title,
+                    on_progress=report_upload, wait=False,
+                )
+                where = upload.get("spreadsheetUrl") or upload.get("filename") or "Google Sheets"
+                if upload.get("uploading"):
+                    result += f"\n\nDataFrame is uploading to {where}."
+                else:
+                    result += f"\n\nDataFrame uploaded to {where}."
             except Exception as upload_err:
                 msg = f"Failed to upload to Google Sheets: {format_exception(upload_err)}"
                 print("upload_error", msg, flush=True)
@@ -242,7 +258,7 @@ def create_execute_dataframe_code(session_id):
                 print(f"Error during broadcaster push: {format_exception(e)}", flush=True)
 
         try:
-            await params.result_callback({"result": result})
+            await params.result_callback({"result": result, **usage})
         except Exception as callback_err:
             print(f"Error in result_callback: {format_exception(callback_err)}", flush=True)
 
@@ -262,12 +278,13 @@ When the user requests analysis, statistics, summary, or inspection, call `execu
 Always provide Python code as a string in the tool call argument named 'code', describing errors when something went wrong and act accordingly to fix them.
 Your output is directly transferred to text-to-speech, so make a natural, concise and to the point summary to the user question that's easy to understand just by listening to it.
 You can also upload intermediate results to google sheets, if the user chooses to, where a new file is created. For this, your code needs to output a pd df that is passed to google sheets and also updating flag upload_to_google_docs.
-If helpful, you can export ONE image as analysis.png, which you save in py code under current directory and is then streamed automatically to user. You should add matplotlib rendering per default to most code for a good UX with using import matplotlib.pyplot as plt. You do NOT say that you exported or vized it. You can combine multiple subplots here in one plot if needed.
+If helpful, draw charts with matplotlib (import matplotlib.pyplot as plt). Every figure your code leaves open is captured and streamed automatically to the user, so do not save or show it. You should add matplotlib rendering per default to most code for a good UX. You do NOT say that you exported or vized it. Prefer one figure, combining multiple subplots in it if needed.
 YOU RESPOND DIRECTLY TO USER QUESTION WITH concise insights in text that is direct and to the point.
 DO NOT FOCUS TOO MUCH ON THE CHART, MAKE THE CODE OUTPUT VALUABLE DATA IN PRINT TO USE THAT DATA, the user cant see the data.
 Explain findings in plain language that non-technical audiences can understand.
 Start with the key insight or recommendation, then provide supporting evidence.
-The user can also ask to enrich (e.g. classify the dataset). For this use enrich_dataset tool. It needs classification_prompt, the instruction on what to look for and possible_values as list of str which are the possible classifcation values, e.g. to defer stance detection code execution. This will automatically generates a google sheet and live updates, which are streamed to the user.
+For quick statistics of a column (distribution, top values, quantiles, nulls) prefer lookup_dataset_profile, which answers instantly from a precomputed profile.
+The user can also ask to enrich (e.g. classify the dataset). For this use enrich_dataset tool. It needs classification_prompt, the instruction on what to look for and possible_values as list of str which are the possible classifcation values, e.g. to defer stance detection code execution. Pass context_columns with the columns the classification needs, so only those are sent per row. To fill several columns at once (e.g. sentiment, topic and urgency), put the first in output_col_name/possible_values and the others in additional_targets, mapping each column name to its possible values (an empty list for free text); never start one enrichment per column. For classifications over thousands of rows where every column has possible values, set hybrid to true: the LLM labels a sample, a local model trained on it labels the rows it is sure about, and its agreement with the LLM is reported. This will automatically generates a google sheet and live updates, which are streamed to the user.
 """
 
 
@@ -293,6 +310,28 @@ class SendMessageFrame(FrameProcessor):
         except Exception as e:
             print(f"error {e}")
 
+# Fire-and-forget tasks started per session, kept referenced until they finish
+background_tasks = set()
+
+def start_background(coro, what):
+    """Run coro as a task that the loop cannot collect early; failures are logged."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+
+    def done(task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"{what} failed: {task.exception()!r}")
+
+    task.add_done_callback(done)
+    return task
+
+async def preload_dataset(session_id):
+    try:
+        await sandbox.code_pool.preload(session_id)
+    except Exception as e:
+        logger.warning(f"Could not preload dataset for session {session_id}: {e}")
+
 user_send = SendMessageFrame()
 robot_send = SendMessageFrame()
 async def run_bot(webrtc_connection, session_id=None):
@@ -309,13 +348,15 @@ async def run_bot(webrtc_connection, session_id=None):
     # Create the execute_dataframe_code function with the session_id
     execute_dataframe_code_func = create_execute_dataframe_code(session_id)
     execute_enrich_dataset = enrich_dataset(session_id)
-    llm = OpenAILLMService(
+    lookup_profile_func = lookup_dataset_profile(session_id)
+    llm_service = OpenAILLMService(
         api_key=os.getenv("OPENAI_API_KEY"),
         system_instruction=SYSTEM_PROMPT,
-        tools=ToolsSchema(standard_tools=[execute_dataframe_code_func, execute_enrich_dataset]),
+        tools=ToolsSchema(standard_tools=[execute_dataframe_code_func, execute_enrich_dataset, lookup_profile_func]),
     )
-    llm.register_direct_function(execute_dataframe_code_func)
-    llm.register_direct_function(execute_enrich_dataset)
+    llm_service.register_direct_function(execute_dataframe_code_func)
+    llm_service.register_direct_function(execute_enrich_dataset)
+    llm_service.register_direct_function(lookup_profile_func)
 
     tts = ElevenLabsTTSService(
         api_key=os.getenv("ELEVENLABS_API_KEY"),
@@ -329,20 +370,20 @@ async def run_bot(webrtc_connection, session_id=None):
         language=Language.EN,
     )
 
-    column_info_msg = get_df_column_info(session_id)
+    column_info_msg = await asyncio.to_thread(get_df_column_info, session_id)
     messages = [
         {"role": "system", "content": f"{SYSTEM_PROMPT} {column_info_msg}"},
         {"role": "system", "content": "In the beginning just ask user what he wants to do with the dataset and NOT add any examples"},
     ]
-    context = OpenAILLMContext(messages, tools=ToolsSchema(standard_tools=[execute_dataframe_code_func, execute_enrich_dataset]))
-    context_aggregator = llm.create_context_aggregator(context)
+    context = OpenAILLMContext(messages, tools=ToolsSchema(standard_tools=[execute_dataframe_code_func, execute_enrich_dataset, lookup_profile_func]))
+    context_aggregator = llm_service.create_context_aggregator(context)
 
     pipeline = Pipeline([
         pipecat_transport.input(),
         sst,
         user_send,
         context_aggregator.user(),
-        llm,
+        llm_service,
         robot_send,
         tts,
         pipecat_transport.output(),
@@ -367,6 +408,13 @@ async def run_bot(webrtc_connection, session_id=None):
         logger.info(f"Pipecat Client connected. Session ID: {session_id}")
         token_task = id(task)
         add_to_chat_history(session_id, "assistant", INTRO_MESSAGE)
+        # Warm a worker with this session's dataset before the first question
+        start_background(preload_dataset(session_id), f"Preloading session {session_id}")
+        # Keeps this session's enrichment jobs alive, resuming interrupted ones
+        start_background(
+            asyncio.to_thread(jobs.job_manager.session_connected, session_id),
+            f"Resuming jobs of session {session_id}",
+        )
         # Send context frame
         await task.queue_frames([context_aggregator.user().get_context_frame()])
 
@@ -389,6 +437,7 @@ async def run_bot(webrtc_connection, session_id=None):
     @pipecat_transport.event_handler("on_client_disconnected")
     async def on_client_disconnected(transport, client):
         logger.info("Pipecat Client disconnected")
+        jobs.job_manager.session_disconnected(session_id)
         await task.cancel()
 
 
@@ -1,4 +1,6 @@
 import asyncio
+import threading
+import time
 
 class TranscriptBroadcaster:
     def __init__(self):
@@ -20,6 +22,8 @@ class TranscriptBroadcaster:
 class EnrichmentBroadcaster:
     def __init__(self):
         self.listeners = set()
+        # Loop that owns the listener queues, i.e. the server's loop
+        self.loop = None
 
     async def push(self, message: str, session_id=None):
         # Only send to listeners for that session, if session is specified
@@ -28,7 +32,31 @@ class EnrichmentBroadcaster:
             if session_id is None or sid == session_id:
                 await queue.put(message)
 
+    def publish(self, message: str, session_id=None):
+        """
+        Thread-safe push for code running outside the server loop, such as
+        enrichment workers: the message is handed to the loop that owns the
+        listener queues instead of touching them from this thread.
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return  # nobody has ever listened
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._deliver(message, session_id)
+        else:
+            loop.call_soon_threadsafe(self._deliver, message, session_id)
+
+    def _deliver(self, message, session_id):
+        for sid, queue in list(self.listeners):
+            if session_id is None or sid == session_id:
+                queue.put_nowait(message)
+
     def add_listener(self, session_id=None):
+        self.loop = asyncio.get_running_loop()
         queue = asyncio.Queue()
         self.listeners.add((session_id, queue))
         return queue
@@ -36,5 +64,56 @@ class EnrichmentBroadcaster:
     def remove_listener(self, queue):
         self.listeners = set((sid, q) for (sid, q) in self.listeners if q != queue)
 
+class ProgressReporter:
+    """
+    Coalesces one job's progress messages to at most max_per_second.
+    Messages in between are dropped except the latest, which is delivered
+    when the interval ends so listeners never stay behind. Safe to call
+    from any thread.
+    """
+
+    def __init__(self, broadcaster, session_id=None, max_per_second=5):
+        self.broadcaster = broadcaster
+        self.session_id = session_id
+        self.interval = 1 / max_per_second
+        self.last_sent = float("-inf")
+        self.pending = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def report(self, message: str):
+        with self.lock:
+            wait = self.last_sent + self.interval - time.monotonic()
+            if wait <= 0:
+                self._send(message)
+                return
+            self.pending = message
+            loop = self.broadcaster.loop
+            if self.timer is None and loop is not None and not loop.is_closed():
+                self.timer = True  # claimed; replaced by the handle on the loop
+                loop.call_soon_threadsafe(self._schedule, loop, wait)
+
+    def close(self):
+        """Deliver the last pending message now, e.g. when the job ends."""
+        with self.lock:
+            if self.pending is not None:
+                self._send(self.pending)
+
+    def _schedule(self, loop, wait):
+        with self.lock:
+            if self.timer is True:
+                self.timer = loop.call_later(wait, self._flush_pending)
+
+    def _flush_pending(self):
+        with self.lock:
+            self.timer = None
+            if self.pending is not None:
+                self._send(self.pending)
+
+    def _send(self, message):
+        self.pending = None
+        self.last_sent = time.monotonic()
+        self.broadcaster.publish(message, session_id=self.session_id)
+
 broadcaster = TranscriptBroadcaster()
 enrichment_broadcaster = EnrichmentBroadcaster()
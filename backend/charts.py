@@ -0,0 +1,74 @@
+# Content-addressed store for generated charts, served over HTTP
+import hashlib
+import io
+import os
+import re
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+IMAGES_FOLDER = "charts"
+IMAGE_URL_PREFIX = "/api/images"
+
+# Longest side of a stored chart, in pixels
+MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", "1600"))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "80"))
+
+IMAGE_NAME_RE = re.compile(r"^[0-9a-f]{64}\.(webp|png)$")
+MEDIA_TYPES = {"webp": "image/webp", "png": "image/png"}
+
+
+def recompress(png_bytes):
+    """
+    Shrink a chart for delivery: bound its resolution and re-encode it as
+    WebP, or as a palette PNG when this Pillow build has no WebP support.
+    Returns (bytes, extension). Without Pillow the PNG is kept as is.
+    """
+    if not PIL_AVAILABLE:
+        return png_bytes, "png"
+    img = Image.open(io.BytesIO(png_bytes))
+    img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+    buf = io.BytesIO()
+    try:
+        img.save(buf, format="WEBP", quality=WEBP_QUALITY, method=4)
+        ext = "webp"
+    except (KeyError, OSError):
+        buf = io.BytesIO()
+        img.convert("RGB").quantize(colors=256).save(buf, format="PNG", optimize=True)
+        ext = "png"
+    data = buf.getvalue()
+    # Tiny charts can grow when re-encoded; keep whichever is smaller
+    if len(data) >= len(png_bytes):
+        return png_bytes, "png"
+    return data, ext
+
+
+def image_name(data, ext):
+    return f"{hashlib.sha256(data).hexdigest()}.{ext}"
+
+
+def store_image(data, ext):
+    """
+    Store an encoded image once under its content hash and return its URL
+    path. Identical charts from any session share one file.
+    """
+    name = image_name(data, ext)
+    path = os.path.join(IMAGES_FOLDER, name)
+    if not os.path.exists(path):
+        os.makedirs(IMAGES_FOLDER, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return f"{IMAGE_URL_PREFIX}/{name}"
+
+
+def image_path(name):
+    """Filesystem path of a stored image, or None for an invalid name."""
+    if not IMAGE_NAME_RE.match(name):
+        return None
+    path = os.path.join(IMAGES_FOLDER, name)
+    return path if os.path.exists(path) else None
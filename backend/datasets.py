@@ -0,0 +1,288 @@
+# Session dataset loading with an in-process LRU cache
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+PANDAS_MAJOR = int(pd.__version__.split(".")[0])
+DATA_FOLDER = "data"
+DEFAULT_DATASET = "airline.csv"
+
+# Memory budget for all cached frames together, in megabytes
+DATASET_CACHE_MAX_MB = int(os.getenv("DATASET_CACHE_MAX_MB", "1024"))
+
+
+def columnar_path(csv_path):
+    """Path of the columnar copy written next to a CSV at ingest."""
+    return os.path.splitext(csv_path)[0] + ".arrow"
+
+
+def schema_path(csv_path):
+    """Path of the schema sidecar written next to a CSV at upload."""
+    return os.path.splitext(csv_path)[0] + ".schema.json"
+
+
+def columns_manifest_path(csv_path):
+    """Path of the manifest of enriched columns appended to a CSV's dataset."""
+    return os.path.splitext(csv_path)[0] + ".columns.json"
+
+
+def columns_folder(csv_path):
+    """Folder holding the files of columns appended to a CSV's dataset."""
+    return os.path.splitext(csv_path)[0] + ".columns"
+
+
+def read_schema_file(csv_path):
+    """Return the schema sidecar of a CSV, or None if there is none."""
+    try:
+        with open(schema_path(csv_path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def read_schema(session_id):
+    """
+    Return the schema sidecar for a session's upload, or None if there is
+    none. Never touches the dataset itself.
+    """
+    return read_schema_file(os.path.join(DATA_FOLDER, f"{session_id}.csv"))
+
+
+def dataset_candidates(session_id):
+    """Paths tried, in order, when loading the dataset for a session."""
+    csv_path = os.path.join(DATA_FOLDER, f"{session_id}.csv")
+    candidates = [csv_path, f"{session_id}.csv", DEFAULT_DATASET]
+    if PYARROW_AVAILABLE:
+        candidates.insert(0, columnar_path(csv_path))
+    return candidates
+
+
+def resolve_dataset_path(session_id):
+    """Return the first existing dataset path for a session, or None."""
+    for path in dataset_candidates(session_id):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def enable_copy_on_write():
+    """
+    Turn on pandas copy-on-write for this process. It is a process-wide
+    setting, so the entry points call this explicitly at startup (main.py
+    for the server, the sandbox for its workers) rather than it being an
+    import side effect. It is always on from pandas 3.0, and opt-in on 2.x.
+    """
+    if PANDAS_MAJOR < 3:
+        pd.set_option("mode.copy_on_write", True)
+
+
+def copy_on_write_enabled():
+    """Whether writes to a shallow copy of a frame copy the data first."""
+    return PANDAS_MAJOR >= 3 or pd.get_option("mode.copy_on_write") is True
+
+
+def file_signature(path):
+    """Cheap change detector for a file: (inode, mtime_ns, size)."""
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def read_frame(path):
+    """
+    Read a dataset file into a DataFrame.
+    Arrow files are memory-mapped, so untouched columns stay in the page
+    cache and are shared between processes reading the same file.
+    """
+    if path.endswith(".arrow") and PYARROW_AVAILABLE:
+        table = feather.read_table(path, memory_map=True)
+        return table.to_pandas(split_blocks=True)
+    # Uploads keep the delimiter sniffed at upload in their schema sidecar
+    schema = read_schema_file(path)
+    return pd.read_csv(path, sep=schema.get("delimiter", ",") if schema else ",")
+
+
+class DatasetCache:
+    """
+    LRU cache of parsed DataFrames keyed by file path.
+
+    Entries are invalidated when the file is replaced or its mtime or size
+    changes, and the least recently used frames are evicted once the cache
+    grows past max_bytes. Callers get a shallow copy-on-write view, so tool
+    code can add columns or mutate values without touching the cached
+    frame; in a process that has not enabled copy-on-write they get a deep
+    copy instead.
+    """
+
+    def __init__(self, max_bytes=DATASET_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # path -> (signature, df, nbytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        signature = file_signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return _view(entry[1])
+        # Parse outside the lock so other sessions are not blocked
+        df = read_frame(path)
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            self.misses += 1
+            self._discard(path)
+            if nbytes <= self.max_bytes:
+                self.entries[path] = (signature, df, nbytes)
+                self.total_bytes += nbytes
+                self._evict()
+        return _view(df)
+
+    def invalidate(self, path):
+        with self.lock:
+            self._discard(path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _discard(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, (_, _, nbytes) = self.entries.popitem(last=False)
+            self.total_bytes -= nbytes
+
+
+def _view(df):
+    # A shallow copy is only safe to hand out when writes copy first
+    return df.copy(deep=not copy_on_write_enabled())
+
+
+dataset_cache = DatasetCache()
+
+
+def load_dataset(session_id):
+    """
+    Load the dataset for a session through the shared cache.
+    Prefers the columnar copy made at ingest, then the uploaded CSV,
+    then {session_id}.csv and finally the default dataset. Columns
+    appended by enrichment are merged in.
+    Raises FileNotFoundError if none of them exist.
+    """
+    path = resolve_dataset_path(session_id)
+    if path is None:
+        raise FileNotFoundError(f"No dataset found for session {session_id}")
+    df = dataset_cache.get(path)
+    manifest = read_columns_manifest(session_id)
+    if manifest is not None:
+        df = merge_columns(df, session_id, manifest)
+    return df
+
+
+def base_version(session_id):
+    """
+    Identifier of the session's uploaded data, ignoring appended columns:
+    the content digest from the schema sidecar, else the resolved path and
+    its signature.
+    """
+    schema = read_schema(session_id)
+    if schema and schema.get("digest"):
+        return schema["digest"]
+    path = resolve_dataset_path(session_id)
+    if path is None:
+        return None
+    return f"{path}:{file_signature(path)}"
+
+
+def dataset_version(session_id):
+    """
+    Identifier that changes whenever the session's data changes: the base
+    version, or the manifest version once enriched columns are appended.
+    """
+    base = base_version(session_id)
+    manifest = read_columns_manifest(session_id, base) if base is not None else None
+    if manifest is None or not manifest["entries"]:
+        return base
+    return manifest["version"]
+
+
+def read_columns_manifest(session_id, base=None):
+    """
+    Return the appended-columns manifest of a session, or None if there is
+    none or it belongs to an earlier upload.
+    """
+    try:
+        with open(columns_manifest_path(os.path.join(DATA_FOLDER, f"{session_id}.csv"))) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if base is None:
+        base = base_version(session_id)
+    if manifest.get("base_version") != base:
+        return None
+    return manifest
+
+
+def appended_column_series(session_id, manifest):
+    """Yield (name, Series) for every appended column, in manifest order."""
+    folder = columns_folder(os.path.join(DATA_FOLDER, f"{session_id}.csv"))
+    for entry in manifest["entries"]:
+        added = dataset_cache.get(os.path.join(folder, entry["file"]))
+        for col in entry["columns"]:
+            yield col["name"], added[col["name"]]
+
+
+def merge_columns(df, session_id, manifest):
+    """
+    Add the manifest's columns to a frame from the cache. The base frame
+    stays cached as is, and each column file is cached on its own, so an
+    append only ever loads the new columns.
+    """
+    for name, series in appended_column_series(session_id, manifest):
+        if len(series) != len(df):
+            print(f"[datasets] Skipping appended column {name}: {len(series)} rows, dataset has {len(df)}", flush=True)
+            continue
+        df[name] = series.array
+    return df
+
+
+def load_dataset_file(csv_path):
+    """Load a CSV path through the cache, preferring its columnar copy."""
+    arrow_path = columnar_path(csv_path)
+    if PYARROW_AVAILABLE and os.path.exists(arrow_path):
+        return dataset_cache.get(arrow_path)
+    return dataset_cache.get(csv_path)
+
+
+def invalidate_dataset(session_id):
+    """Drop the cached frames for a session, e.g. after a new upload."""
+    csv_path = os.path.join(DATA_FOLDER, f"{session_id}.csv")
+    dataset_cache.invalidate(csv_path)
+    dataset_cache.invalidate(columnar_path(csv_path))
@@ -0,0 +1,210 @@
+# Distilled enrichment: a local TF-IDF + softmax classifier trained on LLM labels
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+# Vocabulary size of the local model (words and word pairs)
+DISTILL_MAX_FEATURES = int(os.getenv("DISTILL_MAX_FEATURES", "20000"))
+# Hybrid mode only pays off on larger runs; below this many rows to label, the LLM does all of them
+DISTILL_MIN_ROWS = int(os.getenv("DISTILL_MIN_ROWS", "1000"))
+# Rows the LLM labels before the first training round; doubled until the model is good enough
+DISTILL_INITIAL_SAMPLE = int(os.getenv("DISTILL_INITIAL_SAMPLE", "200"))
+# Upper bound on the LLM-labelled sample, as a fraction of the rows to label
+DISTILL_MAX_SAMPLE_FRACTION = float(os.getenv("DISTILL_MAX_SAMPLE_FRACTION", "0.2"))
+# Agreement with the LLM required on held-out rows the local model labels
+DISTILL_TARGET_AGREEMENT = float(os.getenv("DISTILL_TARGET_AGREEMENT", "0.95"))
+# Held-out coverage at that agreement that stops the sample from growing
+DISTILL_TARGET_COVERAGE = 0.8
+# Share of the labelled sample kept out of training to measure agreement
+DISTILL_HOLDOUT_FRACTION = 0.2
+# Held-out rows a confidence threshold must be measured on before it is trusted
+MIN_CONFIDENT_HOLDOUT = 10
+# Rows vectorized and classified at a time
+PREDICT_CHUNK_ROWS = 10000
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lower-cased words and adjacent word pairs."""
+    words = TOKEN_RE.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class TfidfVectorizer:
+    """
+    Sublinear TF-IDF over tokenize(), L2-normalized. transform() returns a
+    CSR matrix as (indptr, indices, data) arrays.
+    """
+
+    def __init__(self, max_features=DISTILL_MAX_FEATURES):
+        self.max_features = max_features
+        self.vocabulary = {}
+        self.idf = None
+
+    def fit(self, texts):
+        df = Counter()
+        for text in texts:
+            df.update(set(tokenize(text)))
+        # Most frequent terms first; ties by term so the vocabulary is stable
+        terms = sorted(df, key=lambda term: (-df[term], term))[:self.max_features]
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        n = len(texts)
+        self.idf = np.array([math.log((1 + n) / (1 + df[term])) + 1 for term in terms])
+        return self
+
+    def transform(self, texts):
+        indptr = [0]
+        indices = []
+        data = []
+        for text in texts:
+            counts = Counter(t for t in tokenize(text) if t in self.vocabulary)
+            cols = [self.vocabulary[t] for t in counts]
+            values = np.array([1 + math.log(c) for c in counts.values()]) * self.idf[cols]
+            norm = np.sqrt((values ** 2).sum())
+            indices.extend(cols)
+            data.extend(values / norm if norm else values)
+            indptr.append(len(indices))
+        return np.array(indptr), np.array(indices, dtype=np.int64), np.array(data, dtype=np.float64)
+
+
+class SoftmaxRegression:
+    """Multinomial logistic regression on a CSR matrix, fitted with Adam."""
+
+    def __init__(self, n_features, classes, l2=1e-4, epochs=300, learning_rate=0.1):
+        self.classes = list(classes)
+        self.l2 = l2
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.weights = np.zeros((n_features, len(self.classes)))
+        self.bias = np.zeros(len(self.classes))
+
+    def _logits(self, X):
+        indptr, indices, data = X
+        n = len(indptr) - 1
+        rows = np.repeat(np.arange(n), np.diff(indptr))
+        contrib = self.weights[indices] * data[:, None]
+        logits = np.column_stack([
+            np.bincount(rows, weights=contrib[:, k], minlength=n) for k in range(len(self.classes))
+        ]) if n else np.zeros((0, len(self.classes)))
+        return logits + self.bias, rows
+
+    def predict_proba(self, X):
+        logits, _ = self._logits(X)
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def fit(self, X, y):
+        _, indices, data = X
+        n = len(y)
+        index = {label: k for k, label in enumerate(self.classes)}
+        targets = np.zeros((n, len(self.classes)))
+        targets[np.arange(n), [index[label] for label in y]] = 1
+        params = [self.weights, self.bias]
+        moments = [(np.zeros_like(p), np.zeros_like(p)) for p in params]
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        for step in range(1, self.epochs + 1):
+            logits, rows = self._logits(X)
+            logits -= logits.max(axis=1, keepdims=True)
+            probs = np.exp(logits)
+            probs /= probs.sum(axis=1, keepdims=True)
+            error = (probs - targets) / n
+            grad_w = np.column_stack([
+                np.bincount(indices, weights=data * error[rows, k], minlength=self.weights.shape[0])
+                for k in range(len(self.classes))
+            ]) + self.l2 * self.weights
+            grads = [grad_w, error.sum(axis=0)]
+            for param, grad, (m, v) in zip(params, grads, moments):
+                m *= beta1
+                m += (1 - beta1) * grad
+                v *= beta2
+                v += (1 - beta2) * grad ** 2
+                param -= self.learning_rate * (m / (1 - beta1 ** step)) / (np.sqrt(v / (1 - beta2 ** step)) + eps)
+        return self
+
+
+class DistilledModel:
+    """One SoftmaxRegression per target over a shared vocabulary."""
+
+    def __init__(self, enums):
+        self.enums = enums  # target -> allowed values
+        self.vectorizer = TfidfVectorizer()
+        self.models = {}
+
+    def fit(self, texts, labels):
+        X = self.vectorizer.fit(texts).transform(texts)
+        n_features = len(self.vectorizer.vocabulary)
+        for target, values in self.enums.items():
+            self.models[target] = SoftmaxRegression(n_features, values).fit(X, [label[target] for label in labels])
+        return self
+
+    def predict(self, texts):
+        """Labels as dicts by target, and each row's lowest confidence across targets."""
+        labels = []
+        confidence = []
+        for start in range(0, len(texts), PREDICT_CHUNK_ROWS):
+            X = self.vectorizer.transform(texts[start:start + PREDICT_CHUNK_ROWS])
+            chunk_labels = None
+            chunk_confidence = None
+            for target, model in self.models.items():
+                probs = model.predict_proba(X)
+                best = probs.argmax(axis=1)
+                values = [model.classes[k] for k in best]
+                if chunk_labels is None:
+                    chunk_labels = [{} for _ in values]
+                    chunk_confidence = probs.max(axis=1)
+                else:
+                    chunk_confidence = np.minimum(chunk_confidence, probs.max(axis=1))
+                for label, value in zip(chunk_labels, values):
+                    label[target] = value
+            labels.extend(chunk_labels)
+            confidence.append(chunk_confidence)
+        return labels, np.concatenate(confidence) if confidence else np.zeros(0)
+
+
+def calibrate_threshold(confidence, agree, target=DISTILL_TARGET_AGREEMENT, min_rows=MIN_CONFIDENT_HOLDOUT):
+    """
+    Lowest confidence at which the rows at or above it, at least min_rows
+    of them, agree with the LLM at least `target` of the time, or None if
+    no such cut-off exists.
+    """
+    order = np.argsort(-confidence, kind="stable")
+    precision = np.cumsum(agree[order]) / np.arange(1, len(order) + 1)
+    ok = np.nonzero(precision >= target)[0]
+    ok = ok[ok >= min_rows - 1]
+    if not len(ok):
+        return None
+    return float(confidence[order][ok[-1]])
+
+
+def train_and_evaluate(texts, labels, enums, seed=0):
+    """
+    Train a DistilledModel on part of the LLM-labelled sample and measure
+    it against the LLM on the rest. Returns (model, threshold, metrics);
+    the model only labels rows whose confidence reaches threshold.
+    """
+    order = np.random.default_rng(seed).permutation(len(texts))
+    n_holdout = max(1, int(len(texts) * DISTILL_HOLDOUT_FRACTION))
+    holdout, train = order[:n_holdout], order[n_holdout:]
+    model = DistilledModel(enums).fit([texts[i] for i in train], [labels[i] for i in train])
+    predicted, confidence = model.predict([texts[i] for i in holdout])
+    agree = np.array([predicted[j] == labels[i] for j, i in enumerate(holdout)], dtype=float)
+    threshold = calibrate_threshold(confidence, agree)
+    confident = confidence >= threshold if threshold is not None else np.zeros(len(holdout), dtype=bool)
+    metrics = {
+        "sample_rows": len(texts),
+        "holdout_rows": int(n_holdout),
+        "holdout_agreement": round(float(agree.mean()), 4),
+        "target_agreement": {
+            target: round(float(np.mean([predicted[j][target] == labels[i][target] for j, i in enumerate(holdout)])), 4)
+            for target in enums
+        },
+        "threshold": round(threshold, 4) if threshold is not None else None,
+        "holdout_coverage": round(float(confident.mean()), 4),
+        "holdout_confident_agreement": round(float(agree[confident].mean()), 4) if confident.any() else None,
+    }
+    return model, threshold, metrics
@@ -1,23 +1,90 @@
-from sheets import create_and_upload_df, append_rows_to_sheet
+from sheets import BufferedSheetWriter, create_and_upload_df
 import json
+import random
+import re
 import pandas as pd
-from openai import OpenAI
 import os
 from dotenv import load_dotenv
 import time
-import threading
-from broadcast import enrichment_broadcaster
+from broadcast import ProgressReporter, enrichment_broadcaster
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-
-executor = ThreadPoolExecutor(max_workers=1) 
+from ratelimit import AdaptiveRateLimiter
+import llm
+import labelcache
+from labelcache import label_cache
+import distill
 
 load_dotenv(override=True)
 
+# Rows classified at the same time within one enrichment job
+ENRICHMENT_CONCURRENCY = int(os.getenv("ENRICHMENT_CONCURRENCY", "16"))
+# Client-side budget per job, kept under the account's OpenAI limits
+ENRICHMENT_REQUESTS_PER_MINUTE = int(os.getenv("ENRICHMENT_REQUESTS_PER_MINUTE", "500"))
+ENRICHMENT_TOKENS_PER_MINUTE = int(os.getenv("ENRICHMENT_TOKENS_PER_MINUTE", "200000"))
+ENRICHMENT_MAX_RETRIES = int(os.getenv("ENRICHMENT_MAX_RETRIES", "6"))
+
+# Completion tokens budgeted for the parts of a result the schema does not size:
+# the function call around it, a batch item's row_id, a boolean and a free-text value
+FUNCTION_CALL_OUTPUT_TOKENS = 10
+ROW_ID_OUTPUT_TOKENS = 6
+BOOLEAN_OUTPUT_TOKENS = 2
+FREE_TEXT_OUTPUT_TOKENS = 32
+
+# USD per million tokens, for the cost estimate shown before a run (gpt-4.1-nano)
+ENRICHMENT_INPUT_COST_PER_MTOK = float(os.getenv("ENRICHMENT_INPUT_COST_PER_MTOK", "0.10"))
+ENRICHMENT_OUTPUT_COST_PER_MTOK = float(os.getenv("ENRICHMENT_OUTPUT_COST_PER_MTOK", "0.40"))
+
+# Progress messages per second and job sent to enrichment-events listeners
+ENRICHMENT_PROGRESS_PER_SECOND = float(os.getenv("ENRICHMENT_PROGRESS_PER_SECOND", "5"))
+
+# Rows packed into one call: estimated context tokens and a row cap.
+# ENRICHMENT_BATCH_MAX_ROWS=1 sends one row per call.
+ENRICHMENT_BATCH_TOKENS = int(os.getenv("ENRICHMENT_BATCH_TOKENS", "2000"))
+ENRICHMENT_BATCH_MAX_ROWS = int(os.getenv("ENRICHMENT_BATCH_MAX_ROWS", "20"))
+
+
+def estimate_tokens(text):
+    """Rough token count for rate limiting, about four characters per token."""
+    return len(text) // 4 + 1
+
+
+def expected_output_tokens(parameter_schema: dict, rows: int = 1) -> int:
+    """
+    Completion tokens of one call returning `rows` results under a row
+    schema: each target's key plus its longest enum value, a boolean or a
+    free-text allowance, and the function call around them. Results of a
+    multi-row call also carry their row_id.
+    """
+    per_row = 0
+    for name, prop in parameter_schema["properties"].items():
+        if prop.get("enum"):
+            value = max(estimate_tokens(str(v)) for v in prop["enum"])
+        elif prop.get("type") == "boolean":
+            value = BOOLEAN_OUTPUT_TOKENS
+        else:
+            value = FREE_TEXT_OUTPUT_TOKENS
+        per_row += estimate_tokens(f'"{name}": "",') + value
+    if rows > 1:
+        per_row += ROW_ID_OUTPUT_TOKENS
+    return FUNCTION_CALL_OUTPUT_TOKENS + per_row * rows
+
+
+# What a response without usable function-call arguments raises when parsed:
+# bad JSON, no function_call, no choices or arguments that are not a string
+MALFORMED_RESPONSE_ERRORS = (ValueError, AttributeError, IndexError, TypeError)
+
+
+class EnrichmentCancelled(Exception):
+    """Raised by enrich_dataset when its job is cancelled part way."""
+
+
 class Generator:
-    def __init__(self, model: str = "gpt-4.1-nano"):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def __init__(self, model: str = "gpt-4.1-nano", rate_limiter: AdaptiveRateLimiter = None,
+                 gateway: llm.LLMGateway = None):
+        # Calls share the process-wide connection pool and concurrency cap
+        self.gateway = gateway or llm.gateway
         self.model = model
+        self.rate_limiter = rate_limiter
 
     def structured_enrich(
         self, 
@@ -34,7 +101,8 @@ class Generator:
             "parameters": parameter_schema
         }]
         messages = [{"role": "user", "content": prompt.format(context=row_context)}]
-        response = self.client.chat.completions.create(
+        response = self.gateway.chat_sync(
+            tag="enrichment",
             model=self.model,
             messages=messages,
             functions=functions,
@@ -43,95 +111,561 @@ class Generator:
         )
         return json.loads(response.choices[0].message.function_call.arguments)
 
-def make_schema_and_description(col_name: str, possible_values: list[str]) -> tuple[dict, str]:
-    prop = {
-        "type": "string",
-        "description": f"The {col_name} of the statement."
-    }
-    if possible_values:
-        prop["enum"] = possible_values
-        desc = f"Classify the input according to '{col_name}'. Must be one of: {possible_values}."
+    async def _acall_function(self, messages, function, temperature, tokens):
+        """
+        Force a function call and return its parsed arguments. The gateway
+        waits for the rate limiter before each attempt and retries 429s,
+        timeouts and server errors.
+        """
+        response = await self.gateway.chat(
+            tag="enrichment",
+            rate_limiter=self.rate_limiter,
+            tokens=tokens,
+            max_retries=ENRICHMENT_MAX_RETRIES,
+            model=self.model,
+            messages=messages,
+            functions=[function],
+            function_call={"name": function["name"]},
+            temperature=temperature,
+        )
+        return json.loads(response.choices[0].message.function_call.arguments)
+
+    async def astructured_enrich(
+        self,
+        row_context: str,
+        function_name: str,
+        function_description: str,
+        parameter_schema: dict,
+        prompt: str,
+        temperature: float = 0.0
+    ):
+        """Async structured_enrich, rate limited and retried."""
+        function = {
+            "name": function_name,
+            "description": function_description,
+            "parameters": parameter_schema
+        }
+        content = prompt.format(context=row_context)
+        tokens = estimate_tokens(content + function_description + json.dumps(parameter_schema))
+        messages = [{"role": "user", "content": content}]
+        return await self._acall_function(messages, function, temperature, tokens + expected_output_tokens(parameter_schema))
+
+    async def abatch_enrich(
+        self,
+        row_contexts: list[str],
+        function_name: str,
+        function_description: str,
+        parameter_schema: dict,
+        prompt: str,
+        temperature: float = 0.0
+    ) -> dict:
+        """
+        Enrich several rows with one call. Rows are numbered from 0 in the
+        prompt and the function returns one item per row, keyed by row_id.
+
+        Returns {row_id: arguments} for the items that came back; missing
+        or duplicated row ids are left for the caller to retry.
+        """
+        batch_schema = make_batch_schema(parameter_schema)
+        function = {
+            "name": f"{function_name}_batch",
+            "description": f"{function_description} Return one result for every row, with its row_id.",
+            "parameters": batch_schema
+        }
+        context = "\n".join(f"[row_id {i}] {row}" for i, row in enumerate(row_contexts))
+        content = prompt.format(context=context)
+        tokens = estimate_tokens(content + function["description"] + json.dumps(batch_schema))
+        tokens += expected_output_tokens(parameter_schema, len(row_contexts))
+        messages = [{"role": "user", "content": content}]
+        arguments = await self._acall_function(messages, function, temperature, tokens)
+        results = {}
+        seen = set()
+        for item in arguments.get("results", []) if isinstance(arguments, dict) else []:
+            row_id = item.get("row_id") if isinstance(item, dict) else None
+            if not isinstance(row_id, int) or not 0 <= row_id < len(row_contexts):
+                continue
+            if row_id in seen:
+                # Conflicting answers for one row; trust neither
+                results.pop(row_id, None)
+                continue
+            seen.add(row_id)
+            results[row_id] = {k: v for k, v in item.items() if k != "row_id"}
+        return results
+
+def make_schema_and_description(col_name: str | list[str],
+                                possible_values: list[str] | dict[str, list[str]] = None) -> tuple[dict, str]:
+    """
+    Function schema and description for one or several target columns.
+    For one column, possible_values is its enum; for a list of columns it
+    is a dict of enums by column. A missing or empty enum means free text.
+    """
+    if isinstance(col_name, str):
+        targets = {col_name: possible_values}
     else:
-        desc = f"Extract the '{col_name}' from the input as a string."
+        if possible_values is not None and not isinstance(possible_values, dict):
+            raise ValueError("possible_values must map each target column to its values")
+        targets = {name: (possible_values or {}).get(name) for name in col_name}
+    properties = {}
+    descriptions = []
+    for name, values in targets.items():
+        prop = {
+            "type": "string",
+            "description": f"The {name} of the statement."
+        }
+        if values:
+            prop["enum"] = values
+            descriptions.append(f"Classify the input according to '{name}'. Must be one of: {values}.")
+        else:
+            descriptions.append(f"Extract the '{name}' from the input as a string.")
+        properties[name] = prop
     schema = {
         "type": "object",
-        "properties": {col_name: prop},
-        "required": [col_name]
+        "properties": properties,
+        "required": list(targets)
     }
-    return schema, desc
+    return schema, " ".join(descriptions)
 
-def row_to_context(row: pd.Series) -> str:
-    return "; ".join([f"{col}: {row[col]}" for col in row.index])
+def function_name_for(targets: list[str]) -> str:
+    """OpenAI function name for the targets: letters, digits, '_' and '-', at most 64 chars."""
+    return re.sub(r"[^a-zA-Z0-9_-]", "_", "classify_" + "_".join(targets))[:64]
+
+def make_batch_schema(parameter_schema: dict) -> dict:
+    """Wrap a single-row schema into an array of results keyed by row_id."""
+    item = {
+        "type": "object",
+        "properties": {
+            "row_id": {"type": "integer", "description": "The row_id given with the row."},
+            **parameter_schema["properties"],
+        },
+        "required": ["row_id"] + list(parameter_schema.get("required", [])),
+    }
+    return {
+        "type": "object",
+        "properties": {"results": {"type": "array", "items": item}},
+        "required": ["results"],
+    }
+
+def is_valid_result(result: dict, parameter_schema: dict) -> bool:
+    """Check a returned result against the required fields and enums of a schema."""
+    if not isinstance(result, dict):
+        return False
+    for key in parameter_schema.get("required", []):
+        value = result.get(key)
+        prop = parameter_schema["properties"][key]
+        if not isinstance(value, str):
+            return False
+        if "enum" in prop and value not in prop["enum"]:
+            return False
+    return True
+
+def pack_batches(contexts: list[str], token_budget: int, max_rows: int) -> list[list[int]]:
+    """
+    Group row positions into consecutive batches whose estimated context
+    tokens stay within token_budget, with at most max_rows rows each. A
+    row larger than the budget gets a batch of its own.
+    """
+    batches = []
+    current = []
+    used = 0
+    for pos, context in enumerate(contexts):
+        tokens = estimate_tokens(context)
+        if current and (used + tokens > token_budget or len(current) >= max_rows):
+            batches.append(current)
+            current = []
+            used = 0
+        current.append(pos)
+        used += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def infer_context_columns(pd_df: pd.DataFrame, prompt: str, exclude: list[str] = ()) -> list[str]:
+    """
+    Columns the prompt mentions by name (case-insensitive, '_' and spaces
+    interchangeable), or every column if it mentions none.
+    """
+    text = " ".join(prompt.lower().replace("_", " ").split())
+    candidates = [col for col in pd_df.columns if col not in exclude]
+    mentioned = [
+        col for col in candidates
+        if re.search(rf"(?<!\w){re.escape(' '.join(str(col).lower().replace('_', ' ').split()))}(?!\w)", text)
+    ]
+    return mentioned or candidates
+
+def build_contexts(pd_df: pd.DataFrame, columns: list[str]) -> list[str]:
+    """
+    'col: value; col: value' for every row over the given columns. Works a
+    column at a time on plain lists instead of building a Series per row.
+    """
+    if not columns:
+        return [""] * len(pd_df)
+    parts = [[f"{col}: {value}" for value in pd_df[col].tolist()] for col in columns]
+    return ["; ".join(row) for row in zip(*parts)]
+
+def estimate_run(contexts: list[str], batches: list[list[int]], prompt: str, description: str, schema: dict) -> dict:
+    """Estimated calls, tokens and USD cost of the calls a run still has to make."""
+    single_overhead = estimate_tokens(prompt + description + json.dumps(schema))
+    batch_overhead = estimate_tokens(prompt + description + json.dumps(make_batch_schema(schema)))
+    input_tokens = 0
+    output_tokens = 0
+    for batch in batches:
+        input_tokens += single_overhead if len(batch) == 1 else batch_overhead
+        input_tokens += sum(estimate_tokens(contexts[pos]) for pos in batch)
+        output_tokens += expected_output_tokens(schema, len(batch))
+    cost = (input_tokens * ENRICHMENT_INPUT_COST_PER_MTOK + output_tokens * ENRICHMENT_OUTPUT_COST_PER_MTOK) / 1e6
+    return {
+        "calls": len(batches),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost_usd": round(cost, 4),
+    }
 
 def enrich_dataset(
     pd_df: pd.DataFrame,
     prompt: str,
-    col_name: str,
-    possible_values: list[str] = None,
+    col_name: str | list[str],
+    possible_values: list[str] | dict[str, list[str]] = None,
     sheet_name: str = "Sheet1",
     title: str = "Enriched Dataset",
-    session_id: str = None
+    session_id: str = None,
+    job=None,
+    context_columns: list[str] = None,
+    hybrid: bool = False
 ) -> dict:
     """
     Creates a new Google Sheet, and as each row is enriched, appends it immediately.
+
+    col_name may be a list of target columns, with possible_values a dict
+    of enums by column; every target is filled from the same call.
+
+    Only context_columns are sent to the model; by default, the columns the
+    prompt mentions by name, or all of them if it mentions none. The sheet
+    always gets every column.
+
+    When run as a jobs.EnrichmentJob, labels are checkpointed to the job as
+    they arrive and a resumed job skips checkpointed rows and continues the
+    sheet it already created. Raises EnrichmentCancelled if the job is
+    cancelled; rows enriched so far are still written.
+
+    With hybrid=True and enum targets, the LLM labels a sample and a local
+    model distilled from it labels the rows it is confident about (see
+    distill.py); the rest still go to the LLM.
+
     Returns a dict containing:
         - 'dataframe': The enriched DataFrame.
         - 'spreadsheet_id': The Sheet ID.
         - 'spreadsheet_url': The Sheet Web URL.
         - 'mode': 'created'
     """
+    targets = [col_name] if isinstance(col_name, str) else list(col_name)
     schema, description = make_schema_and_description(col_name, possible_values)
-    function_name = f"classify_{col_name}"
-    generator = Generator()
+    function_name = function_name_for(targets)
+    generator = Generator(rate_limiter=AdaptiveRateLimiter(
+        ENRICHMENT_REQUESTS_PER_MINUTE, ENRICHMENT_TOKENS_PER_MINUTE
+    ))
 
     # 1. Create an empty dataframe with the extra col (header only)
     upload_df = pd_df.copy()
-    if col_name not in upload_df.columns:
-        upload_df[col_name] = ""
+    for target in targets:
+        if target not in upload_df.columns:
+            upload_df[target] = ""
     header_only = upload_df.iloc[0:0]
 
-    # Create the sheet with only headers
-    create_resp = create_and_upload_df(
-        header_only,
-        title=title,
-        sheet_name=sheet_name
-    )
-    spreadsheet_id = create_resp['spreadsheetId']
-
-    enriched_values = []
-    # 2. Enrich and append each row immediately
-    for idx, row in pd_df.iterrows():
-        context = row_to_context(row)
-        llm_result = generator.structured_enrich(
-            row_context=context,
-            function_name=function_name,
-            function_description=description,
-            parameter_schema=schema,
-            prompt=prompt,
-        )
-        pd_df.at[idx, col_name] = llm_result[col_name]
-        row_with_col = row.copy()
-        row_with_col[col_name] = llm_result[col_name]
-        ordered_row = [str(row_with_col[col]) for col in upload_df.columns]
-        append_rows_to_sheet(
-            spreadsheet_id=spreadsheet_id,
-            sheet_name=sheet_name,
-            rows=[ordered_row]
+    if job is not None and job.spreadsheet_id:
+        # Resuming: keep appending to the sheet the job already created
+        spreadsheet_id = job.spreadsheet_id
+        spreadsheet_url = job.spreadsheet_url
+        sheet_offset = job.sheet_rows
+        mode = "resumed"
+    else:
+        # Create the sheet with only headers
+        create_resp = create_and_upload_df(
+            header_only,
+            title=title,
+            sheet_name=sheet_name
         )
-        sheet_url = create_resp.get('spreadsheetUrl')
-        log_msg = f"Enriched row {idx+1}/{len(pd_df)}. View: {sheet_url}"
-        asyncio.run(enrichment_broadcaster.push(log_msg, session_id=session_id))
+        spreadsheet_id = create_resp['spreadsheetId']
+        # The disk fallback has no URL; point at the local file instead
+        spreadsheet_url = create_resp.get('spreadsheetUrl') or create_resp.get('filename')
+        sheet_offset = 0
+        mode = "created"
+        if job is not None:
+            job.set_sheet(spreadsheet_id, spreadsheet_url)
+
+    on_flush = None
+    if job is not None:
+        on_flush = lambda written: job.record_progress(sheet_rows=sheet_offset + written)
+    if context_columns is None:
+        context_columns = infer_context_columns(pd_df, prompt, exclude=targets)
+    contexts = build_contexts(pd_df, context_columns)
+    # 2. Enrich rows concurrently, appending them to the sheet in order
+    with BufferedSheetWriter(spreadsheet_id, sheet_name, on_flush=on_flush) as sheet_writer:
+        labels = asyncio.run(_enrich_rows(
+            pd_df, contexts, generator, prompt, targets, function_name, description, schema,
+            sheet_writer, list(upload_df.columns), spreadsheet_url, session_id, job, sheet_offset, hybrid,
+        ))
+    for target in targets:
+        pd_df[target] = [label[target] for label in labels]
 
     return {
         "dataframe": pd_df,
         "spreadsheet_id": spreadsheet_id,
-        "spreadsheet_url": create_resp.get('spreadsheetUrl'),
-        "mode": "created"
+        "spreadsheet_url": spreadsheet_url,
+        "mode": mode
     }
 
-def run_enrichment_in_background(*args, **kwargs):
-    future = executor.submit(enrich_dataset, *args, **kwargs)
-    return future
+async def _enrich_rows(pd_df, contexts, generator, prompt, targets, function_name, description, schema,
+                       sheet_writer, columns, sheet_url, session_id, job=None, sheet_offset=0, hybrid=False):
+    """
+    Classify every row with up to ENRICHMENT_CONCURRENCY calls in flight.
+    Rows are packed into batches of up to ENRICHMENT_BATCH_TOKENS context
+    tokens per call; rows a batch returns missing or invalid are retried
+    one at a time.
+
+    Rows with the same context share one call, and labels already in the
+    on-disk label cache for this model, prompt and schema are reused.
+
+    In hybrid mode the LLM first labels a random sample, doubled until a
+    distilled model agrees with it well enough on a held-out slice (or the
+    sample reaches DISTILL_MAX_SAMPLE_FRACTION); the model then labels the
+    rows it is confident about and only the others go to the LLM.
+
+    Results may arrive out of order; they are handed to the sheet writer as
+    soon as the next row in order is done, so the sheet and the returned
+    labels always follow the DataFrame's row order.
+    """
+    total = len(pd_df)
+    labels = [None] * total
+    done = [False] * total
+    def pick(llm_result):
+        if not isinstance(llm_result, dict):
+            llm_result = {}
+        return {target: llm_result.get(target, "") for target in targets}
+
+    if job is not None:
+        for pos, label in job.labels.items():
+            # Checkpoints from single-target runs hold the bare value
+            labels[pos] = label if isinstance(label, dict) else {targets[0]: label}
+            done[pos] = True
+
+    # Collapse identical rows, then look their keys up in the label cache
+    keys = [labelcache.make_key(generator.model, prompt, schema, context) for context in contexts]
+    positions = {}
+    for pos, key in enumerate(keys):
+        if not done[pos]:
+            positions.setdefault(key, []).append(pos)
+    cached = await asyncio.to_thread(label_cache.get_many, positions)
+    for key, llm_result in cached.items():
+        for pos in positions[key]:
+            labels[pos] = pick(llm_result)
+            done[pos] = True
+    if job is not None:
+        await asyncio.to_thread(job.record_labels, [
+            (pos, labels[pos]) for key in cached for pos in positions[key]
+        ])
+    pending = [same[0] for key, same in positions.items() if key not in cached]
+    cache_stats = {"hits": len(cached), "misses": len(pending),
+                   "duplicates": sum(len(same) - 1 for same in positions.values())}
+
+    def make_batches(rows):
+        return [
+            [rows[i] for i in batch]
+            for batch in pack_batches([contexts[pos] for pos in rows], ENRICHMENT_BATCH_TOKENS, ENRICHMENT_BATCH_MAX_ROWS)
+        ]
+
+    enums = {target: schema["properties"][target].get("enum") for target in targets}
+    if hybrid and not all(enums.values()):
+        print("[enrichment] Hybrid mode needs possible values for every target; using the LLM for all rows", flush=True)
+        hybrid = False
+    if hybrid and len(pending) < distill.DISTILL_MIN_ROWS:
+        print(f"[enrichment] {len(pending)} rows to label, below DISTILL_MIN_ROWS; using the LLM for all rows", flush=True)
+        hybrid = False
+
+    # Without distillation this is the plan; with it, an upper bound
+    estimate = estimate_run(contexts, make_batches(pending), prompt, description, schema)
+    print(f"[enrichment] Plan: {total} rows, {estimate['calls']} calls after cache, "
+          f"~{estimate['input_tokens']} input tokens, ~${estimate['cost_usd']}"
+          f"{' (at most, hybrid mode)' if hybrid else ''}", flush=True)
+    if job is not None:
+        job.set_estimate(estimate)
+    next_flush = sheet_offset
+    calls = 0
+    retried = 0
+    distilled = 0
+    flush_lock = asyncio.Lock()
+    started = time.monotonic()
+    # Runs off the server loop; coalesce and hand messages over thread-safely
+    progress = ProgressReporter(enrichment_broadcaster, session_id, ENRICHMENT_PROGRESS_PER_SECOND)
+    progress.report(
+        f"Enrichment plan: {total} rows, {'up to ' if hybrid else ''}{estimate['calls']} LLM calls, "
+        f"~{estimate['input_tokens']} input tokens, estimated cost ${estimate['cost_usd']:.4f}"
+        f"{' (hybrid: most rows labelled locally)' if hybrid else ''}"
+    )
+
+    async def flush():
+        # One flusher at a time; it keeps going until it catches up, so the
+        # other workers go straight back to classifying instead of waiting.
+        nonlocal next_flush
+        if flush_lock.locked():
+            return
+        async with flush_lock:
+            while True:
+                end = next_flush
+                while end < total and done[end]:
+                    end += 1
+                if end == next_flush:
+                    return
+                rows = []
+                for pos in range(next_flush, end):
+                    row = pd_df.iloc[pos]
+                    rows.append([str(labels[pos][col]) if col in labels[pos] else str(row[col]) for col in columns])
+                await asyncio.to_thread(sheet_writer.write, rows)
+                next_flush = end
+                if job is not None:
+                    job.record_progress(rows_done=end)
+                rate = (end - sheet_offset) / max(time.monotonic() - started, 1e-9)
+                progress.report(
+                    f"Enriched row {end}/{total}. View: {sheet_url} ({rate:.1f} rows/s, "
+                    f"cache {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                    f"{cache_stats['duplicates']} duplicate rows)"
+                )
+
+    def cancelled():
+        return job is not None and job.cancel_requested()
+
+    def assign(pos, label):
+        """Label every row sharing pos's context."""
+        for same in positions[keys[pos]]:
+            labels[same] = label
+            done[same] = True
+        if job is not None:
+            job.record_labels([(same, label) for same in positions[keys[pos]]])
+
+    def resolve(pos, llm_result):
+        """Assign an LLM result; return cacheable (key, result)."""
+        assign(pos, pick(llm_result))
+        return [(keys[pos], llm_result)] if is_valid_result(llm_result, schema) else []
+
+    async def enrich_one(pos):
+        try:
+            llm_result = await generator.astructured_enrich(
+                row_context=contexts[pos],
+                function_name=function_name,
+                function_description=description,
+                parameter_schema=schema,
+                prompt=prompt,
+            )
+        except MALFORMED_RESPONSE_ERRORS as e:
+            # Like an invalid batch row: left unlabeled and not cached
+            print(f"[enrichment] Malformed response for row {pos}, leaving it unlabeled: {e!r}", flush=True)
+            llm_result = None
+        return resolve(pos, llm_result)
+
+    async def worker(batches):
+        nonlocal calls, retried
+        # Workers share one iterator, so each batch is taken exactly once
+        for batch in batches:
+            if cancelled():
+                return
+            calls += 1
+            if len(batch) == 1:
+                await asyncio.to_thread(label_cache.put_many, await enrich_one(batch[0]))
+            else:
+                try:
+                    batch_results = await generator.abatch_enrich(
+                        row_contexts=[contexts[pos] for pos in batch],
+                        function_name=function_name,
+                        function_description=description,
+                        parameter_schema=schema,
+                        prompt=prompt,
+                    )
+                except MALFORMED_RESPONSE_ERRORS as e:
+                    print(f"[enrichment] Malformed batch response, retrying rows one by one: {e}", flush=True)
+                    batch_results = {}
+                missing = []
+                to_cache = []
+                for row_id, pos in enumerate(batch):
+                    llm_result = batch_results.get(row_id)
+                    if is_valid_result(llm_result, schema):
+                        to_cache += resolve(pos, llm_result)
+                    else:
+                        missing.append(pos)
+                retried += len(missing)
+                calls += len(missing)
+                for items in await asyncio.gather(*(enrich_one(pos) for pos in missing)):
+                    to_cache += items
+                await asyncio.to_thread(label_cache.put_many, to_cache)
+            await flush()
+
+    async def label_with_llm(rows):
+        batches = make_batches(rows)
+        shared = iter(batches)
+        workers = [asyncio.create_task(worker(shared)) for _ in range(min(ENRICHMENT_CONCURRENCY, len(batches)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def distill_rows(rows):
+        """Label a growing LLM sample, then let the distilled model label what it can."""
+        nonlocal distilled
+        order = list(rows)
+        random.Random(0).shuffle(order)
+        max_sample = max(distill.DISTILL_INITIAL_SAMPLE, int(len(order) * distill.DISTILL_MAX_SAMPLE_FRACTION))
+        size = min(distill.DISTILL_INITIAL_SAMPLE, max_sample)
+        labelled = 0
+        while True:
+            await label_with_llm(order[labelled:size])
+            labelled = size
+            if cancelled():
+                return
+            # Only valid LLM labels are worth learning from
+            sample = [pos for pos in order[:labelled]
+                      if all(labels[pos][target] in values for target, values in enums.items())]
+            model, threshold, metrics = await asyncio.to_thread(
+                distill.train_and_evaluate, [contexts[pos] for pos in sample], [labels[pos] for pos in sample], enums
+            )
+            print(f"[enrichment] Distilled model on {labelled} LLM rows: {metrics}", flush=True)
+            if metrics["holdout_coverage"] >= distill.DISTILL_TARGET_COVERAGE or size >= max_sample:
+                break
+            size = min(size * 2, max_sample)
+        rest = order[labelled:]
+        predicted, confidence = await asyncio.to_thread(model.predict, [contexts[pos] for pos in rest])
+        uncertain = []
+        for pos, label, score in zip(rest, predicted, confidence):
+            if threshold is not None and score >= threshold:
+                assign(pos, label)
+                distilled += 1
+            else:
+                uncertain.append(pos)
+        metrics.update(distilled_rows=distilled, llm_rows=labelled + len(uncertain))
+        if job is not None:
+            job.set_distill_metrics(metrics)
+        progress.report(
+            f"Distilled model labelled {distilled} of {len(order)} rows locally; "
+            f"{metrics['holdout_agreement']:.1%} agreement with the LLM on {metrics['holdout_rows']} held-out rows "
+            f"({metrics['holdout_confident_agreement'] or 0:.1%} on the rows it labels)"
+        )
+        await flush()
+        await label_with_llm(uncertain)
+
+    if hybrid:
+        await distill_rows(pending)
+    else:
+        await label_with_llm(pending)
+    try:
+        # Rows served entirely from the cache still need to reach the sheet
+        await flush()
+    finally:
+        progress.close()
+    if not all(done):
+        raise EnrichmentCancelled(f"Cancelled after {next_flush}/{total} rows")
+    if generator.rate_limiter is not None:
+        print(f"[enrichment] {total} rows in {calls} calls, {retried} retried singly, {distilled} distilled, cache {cache_stats}, "
+              f"{time.monotonic() - started:.1f}s, limiter {generator.rate_limiter.stats()}", flush=True)
+    return labels
 
 if __name__ == "__main__":
     import pandas as pd
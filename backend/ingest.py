@@ -0,0 +1,438 @@
+# Upload ingest: parse a CSV once and keep a memory-mappable columnar copy
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+
+import pandas as pd
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+from datasets import (
+    DATA_FOLDER, PYARROW_AVAILABLE, base_version, columnar_path, columns_folder, columns_manifest_path,
+    dataset_cache, file_signature, read_columns_manifest, schema_path,
+)
+
+if PYARROW_AVAILABLE:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+# Columnar copies are stored once per content hash, and each session path is
+# a hard link to it, so sessions that upload the same file share page cache.
+COLUMNAR_FOLDER = os.path.join(DATA_FOLDER, "columnar")
+
+# "uncompressed" keeps the file mappable without copies; "zstd" or "lz4"
+# trade load-time decompression for a smaller file on disk.
+COLUMNAR_COMPRESSION = os.getenv("COLUMNAR_COMPRESSION", "uncompressed")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Bytes buffered before sniffing the dialect and inferring column dtypes
+SNIFF_BYTES = 64 * 1024
+
+UPLOAD_SUFFIXES = (".csv", ".csv.gz", ".csv.zst")
+
+# Largest piece of decompressed output produced at a time
+DECOMPRESS_STEP_BYTES = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Raised by the streaming decompressors on a corrupt body
+DECOMPRESSION_ERRORS = (zlib.error, zstandard.ZstdError) if ZSTD_AVAILABLE else (zlib.error,)
+
+# Held while an upload replaces a session's CSV and while ingest publishes
+# the artifacts derived from it, so the two never interleave
+publish_lock = threading.Lock()
+
+
+class StaleUpload(Exception):
+    """The CSV being ingested was replaced by a newer upload."""
+
+
+def hash_file(path):
+    """SHA-256 hex digest of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def discard_artifacts(csv_path):
+    """Remove derived files for a CSV so stale copies are never served."""
+    for path in (columnar_path(csv_path), schema_path(csv_path), columns_manifest_path(csv_path)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(columns_folder(csv_path), ignore_errors=True)
+
+
+def build_schema(df, digest):
+    """Column names, dtypes, null counts and cardinality of a DataFrame."""
+    null_counts = df.isna().sum()
+    cardinality = df.nunique(dropna=True)
+    return {
+        "digest": digest,
+        "row_count": int(df.shape[0]),
+        "columns": [
+            {
+                "name": str(col),
+                "dtype": str(dtype),
+                "null_count": int(null_counts[col]),
+                "cardinality": int(cardinality[col]),
+            }
+            for col, dtype in zip(df.columns, df.dtypes)
+        ],
+        "complete": True,
+    }
+
+
+def write_schema(csv_path, schema):
+    """Persist a schema sidecar next to the CSV, atomically."""
+    path = schema_path(csv_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(schema, f)
+    os.replace(tmp_path, path)
+
+
+def write_columnar(df, path):
+    """Write a DataFrame as an Arrow IPC (Feather v2) file, atomically."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp_path = f"{path}.tmp"
+    feather.write_feather(table, tmp_path, compression=COLUMNAR_COMPRESSION)
+    os.replace(tmp_path, path)
+
+
+# One manifest update at a time; enrichment jobs may finish together
+_append_lock = threading.Lock()
+
+
+def append_columns(session_id, columns_df, source=None):
+    """
+    Add columns to a session's dataset without rewriting it. The columns
+    are written to their own file in data/{session_id}.columns/, named by
+    content digest, and listed in the session's manifest, which
+    load_dataset merges at read time. A column appended again replaces the
+    earlier one. Returns the new dataset version.
+    """
+    csv_path = os.path.join(DATA_FOLDER, f"{session_id}.csv")
+    folder = columns_folder(csv_path)
+    data = columns_df.reset_index(drop=True)
+    data.columns = [str(col) for col in data.columns]
+    with _append_lock:
+        base = base_version(session_id)
+        manifest = read_columns_manifest(session_id, base) or {"base_version": base, "entries": []}
+        os.makedirs(folder, exist_ok=True)
+        suffix = ".arrow" if PYARROW_AVAILABLE else ".csv"
+        staged_path = os.path.join(folder, f"staged{suffix}")
+        if PYARROW_AVAILABLE:
+            write_columnar(data, staged_path)
+        else:
+            data.to_csv(staged_path, index=False)
+        digest = hash_file(staged_path)
+        name = f"{digest}{suffix}"
+        os.replace(staged_path, os.path.join(folder, name))
+
+        # Earlier entries lose the columns appended again, and go once empty
+        entries = []
+        for entry in manifest["entries"]:
+            entry["columns"] = [col for col in entry["columns"] if col["name"] not in data.columns]
+            if entry["columns"]:
+                entries.append(entry)
+        entries.append({
+            "file": name,
+            "digest": digest,
+            "columns": build_schema(data, digest)["columns"],
+            "source": source,
+            "created_at": time.time(),
+        })
+        h = hashlib.sha256(str(base).encode())
+        for entry in entries:
+            h.update(f"\0{entry['digest']}:{','.join(col['name'] for col in entry['columns'])}".encode())
+        manifest = {"base_version": base, "version": h.hexdigest(), "entries": entries}
+
+        path = columns_manifest_path(csv_path)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{path}.tmp", path)
+
+        referenced = {entry["file"] for entry in entries}
+        for leftover in os.listdir(folder):
+            if leftover not in referenced:
+                os.remove(os.path.join(folder, leftover))
+                dataset_cache.invalidate(os.path.join(folder, leftover))
+    print(f"[ingest] Appended {list(data.columns)} to {session_id} ({len(data)} rows, version {manifest['version'][:12]})", flush=True)
+    return manifest["version"]
+
+
+def _link(src, dst):
+    tmp_path = f"{dst}.tmp"
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def ingest_csv(csv_path, digest=None, delimiter=","):
+    """
+    Parse an uploaded CSV once, store its columnar copy next to it and
+    complete the schema sidecar.
+
+    Returns a dict with the content digest, the schema and the parsed
+    DataFrame. Without pyarrow only the sidecar is written and readers
+    fall back to the CSV.
+    """
+    signature = file_signature(csv_path)
+    on_disk = hash_file(csv_path)
+    if digest is not None and on_disk != digest:
+        raise StaleUpload(f"{csv_path} no longer holds upload {digest[:12]}")
+    digest = on_disk
+    df = pd.read_csv(csv_path, sep=delimiter)
+    schema = build_schema(df, digest)
+    schema["delimiter"] = delimiter
+    shared_path = None
+    if PYARROW_AVAILABLE:
+        os.makedirs(COLUMNAR_FOLDER, exist_ok=True)
+        shared_path = os.path.join(COLUMNAR_FOLDER, f"{digest}.arrow")
+        if not os.path.exists(shared_path):
+            write_columnar(df, shared_path)
+    with publish_lock:
+        # A newer upload may have replaced the CSV while this one was parsed
+        if file_signature(csv_path) != signature:
+            raise StaleUpload(f"{csv_path} was replaced during ingest of {digest[:12]}")
+        if shared_path is not None:
+            _link(shared_path, columnar_path(csv_path))
+        write_schema(csv_path, schema)
+    if shared_path is not None:
+        print(f"[ingest] {csv_path} -> {shared_path} ({df.shape[0]} rows)", flush=True)
+    else:
+        print("[ingest] pyarrow not installed, keeping CSV only", flush=True)
+    return {"digest": digest, "schema": schema, "dataframe": df}
+
+
+class UploadWriter:
+    """
+    Writes an upload to disk as it streams in, feeding every decompressed
+    piece to an UploadInspector. gzip (every member of a multi-member
+    file) and zstd (every frame) are decompressed in steps of at most
+    DECOMPRESS_STEP_BYTES, so a small compressed chunk cannot expand into
+    memory all at once. The format is taken from the magic bytes of the
+    first chunk, then the filename suffix. Blocking; run it in a thread.
+    """
+
+    def __init__(self, path, filename, inspector):
+        self.out = open(path, "wb")
+        self.filename = filename
+        self.inspector = inspector
+        self.kind = None
+        self.gzip = None
+        self.gzip_pending = False  # input fed to the current gzip member but not yet ended
+        self.zstd = None
+
+    def write(self, chunk):
+        if self.kind is None:
+            self._detect(chunk)
+        if self.kind == "gzip":
+            self._gunzip(chunk)
+        elif self.kind == "zstd":
+            self.zstd.write(chunk)
+        else:
+            self._emit(chunk)
+
+    def close(self):
+        """Finish the file; raises ValueError if a gzip member was cut off."""
+        try:
+            if self.zstd is not None:
+                self.zstd.flush()
+            if self.gzip_pending:
+                raise ValueError("The gzip upload is truncated")
+        finally:
+            self.out.close()
+
+    def abort(self):
+        """Close the file after a failed upload, without flushing the decompressor."""
+        self.out.close()
+
+    def _detect(self, head):
+        if head.startswith(GZIP_MAGIC) or self.filename.endswith(".gz"):
+            self.kind = "gzip"
+            self.gzip = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        elif head.startswith(ZSTD_MAGIC) or self.filename.endswith(".zst"):
+            if not ZSTD_AVAILABLE:
+                raise ValueError("zstd uploads require the zstandard package")
+            self.kind = "zstd"
+            self.zstd = zstandard.ZstdDecompressor().stream_writer(
+                _Sink(self._emit), write_size=DECOMPRESS_STEP_BYTES, closefd=False
+            )
+        else:
+            self.kind = "plain"
+
+    def _gunzip(self, data):
+        while True:
+            self.gzip_pending = self.gzip_pending or bool(data)
+            out = self.gzip.decompress(data, DECOMPRESS_STEP_BYTES)
+            if out:
+                self._emit(out)
+            if self.gzip.eof:
+                # The next member, if any, starts right after this one
+                data = self.gzip.unused_data
+                self.gzip = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                self.gzip_pending = False
+                if not data:
+                    return
+                continue
+            data = self.gzip.unconsumed_tail
+            # A full step may leave output buffered even with no input left
+            if not data and len(out) < DECOMPRESS_STEP_BYTES:
+                return
+
+    def _emit(self, data):
+        self.inspector.feed(data)
+        self.out.write(data)
+
+
+class _Sink:
+    """File-like target for zstandard's stream_writer."""
+
+    def __init__(self, write):
+        self._write = write
+
+    def write(self, data):
+        self._write(bytes(data))
+        return len(data)
+
+
+def _last_record_end(data, quotechar):
+    """Offset just past the last newline that is outside a quoted field."""
+    end = 0
+    pos = 0
+    in_quotes = False
+    for part in data.split(quotechar):
+        if not in_quotes:
+            nl = part.rfind(b"\n")
+            if nl != -1:
+                end = pos + nl + 1
+        pos += len(part) + len(quotechar)
+        in_quotes = not in_quotes
+    return end
+
+
+class UploadInspector:
+    """
+    Incremental CSV inspection while an upload streams to disk.
+
+    Feed it decompressed chunks in order. It hashes the content, sniffs the
+    dialect from the first SNIFF_BYTES, infers column dtypes from
+    those rows and counts records (newlines outside quoted fields), so the
+    upload response needs no second pass over the file.
+    """
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.head = bytearray()
+        self.sniffed = False
+        self.delimiter = ","
+        self.quotechar = b'"'
+        self.columns = []
+        self.newlines = 0
+        self.in_quotes = False
+        self.last_byte = b""
+        self.total_bytes = 0
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        self.hasher.update(chunk)
+        self.total_bytes += len(chunk)
+        if self.sniffed:
+            self._count(chunk)
+            return
+        self.head.extend(chunk)
+        if len(self.head) >= SNIFF_BYTES:
+            self._sniff()
+
+    def finish(self):
+        if not self.sniffed:
+            self._sniff()
+        return self.schema()
+
+    @property
+    def digest(self):
+        return self.hasher.hexdigest()
+
+    @property
+    def row_count(self):
+        records = self.newlines
+        if self.total_bytes and self.last_byte != b"\n":
+            records += 1  # last record without a trailing newline
+        if records:
+            records -= 1  # header line
+        return records
+
+    def schema(self):
+        # "complete" is False: dtypes come from a sample and null counts and
+        # cardinality are only known after the full parse at ingest.
+        return {
+            "columns": self.columns,
+            "row_count": self.row_count,
+            "delimiter": self.delimiter,
+            "bytes": self.total_bytes,
+            "digest": self.digest,
+            "complete": False,
+        }
+
+    def _sniff(self):
+        head = bytes(self.head)
+        self.sniffed = True
+        self.head = bytearray()
+        # Only sniff complete records so a cut-off one does not skew it
+        sample = head[:SNIFF_BYTES]
+        complete = sample[:_last_record_end(sample, self.quotechar)] or sample
+        text = complete.decode("utf-8", errors="replace")
+        try:
+            dialect = csv.Sniffer().sniff(text, delimiters=",;\t|")
+            self.delimiter = dialect.delimiter
+            self.quotechar = dialect.quotechar.encode()
+        except csv.Error:
+            pass
+        self._infer_columns(text)
+        self._count(head)
+
+    def _infer_columns(self, text):
+        if not text.strip():
+            return
+        try:
+            sample = pd.read_csv(io.StringIO(text), sep=self.delimiter)
+        except Exception as e:
+            print(f"[ingest] Could not infer columns from sample: {e}", flush=True)
+            return
+        self.columns = [
+            {"name": str(col), "dtype": str(dtype)}
+            for col, dtype in zip(sample.columns, sample.dtypes)
+        ]
+
+    def _count(self, chunk):
+        parts = chunk.split(self.quotechar)
+        for i, part in enumerate(parts):
+            if not self.in_quotes:
+                self.newlines += part.count(b"\n")
+            if i < len(parts) - 1:
+                self.in_quotes = not self.in_quotes
+        self.last_byte = chunk[-1:]
@@ -0,0 +1,397 @@
+# Enrichment jobs: background execution with checkpoints, status and resume
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import datasets
+import enrichment
+import ingest
+import profiling
+
+JOBS_FOLDER = os.path.join(datasets.DATA_FOLDER, "jobs")
+
+# Jobs run one after another; each one already has many LLM calls in flight
+ENRICHMENT_JOB_WORKERS = int(os.getenv("ENRICHMENT_JOB_WORKERS", "1"))
+# How long a job outlives its session's disconnect before it is cancelled
+JOB_ORPHAN_GRACE_SECONDS = float(os.getenv("JOB_ORPHAN_GRACE_SECONDS", "300"))
+# Minimum seconds between status file writes while a job runs
+STATUS_WRITE_INTERVAL = 1.0
+
+ACTIVE_STATES = ("queued", "running")
+RESUMABLE_STATES = ("interrupted", "cancelled", "failed")
+
+
+class EnrichmentJob:
+    """
+    One enrich_dataset run. Status lives in data/jobs/{job_id}.json and
+    every label is appended to data/jobs/{job_id}.jsonl as it is produced,
+    so a resumed job neither pays for those rows again nor writes sheet
+    rows twice.
+    """
+
+    def __init__(self, job_id, session_id, params, dataset_path, dataset_version, total_rows):
+        self.job_id = job_id
+        self.session_id = session_id
+        self.params = params
+        self.dataset_path = dataset_path
+        self.dataset_version = dataset_version
+        self.total_rows = total_rows
+        self.status = "queued"
+        self.error = None
+        self.rows_done = 0
+        self.sheet_rows = 0
+        self.spreadsheet_id = None
+        self.spreadsheet_url = None
+        self.estimate = None
+        self.distill = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.labels = {}
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.checkpoint = None
+        self.run_started = None
+        self.run_start_rows = 0
+        self.last_write = 0.0
+
+    @property
+    def status_path(self):
+        return os.path.join(JOBS_FOLDER, f"{self.job_id}.json")
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(JOBS_FOLDER, f"{self.job_id}.jsonl")
+
+    def rows_per_second(self):
+        if self.status != "running" or self.run_started is None:
+            return None
+        elapsed = time.monotonic() - self.run_started
+        if elapsed <= 0:
+            return None
+        return (self.rows_done - self.run_start_rows) / elapsed
+
+    def eta_seconds(self):
+        rate = self.rows_per_second()
+        if not rate:
+            return None
+        return (self.total_rows - self.rows_done) / rate
+
+    def to_dict(self):
+        rate = self.rows_per_second()
+        eta = self.eta_seconds()
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "status": self.status,
+            "title": self.params.get("title"),
+            "col_name": self.params.get("col_name"),
+            "total_rows": self.total_rows,
+            "rows_done": self.rows_done,
+            "rows_per_second": round(rate, 2) if rate is not None else None,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "spreadsheet_id": self.spreadsheet_id,
+            "spreadsheet_url": self.spreadsheet_url,
+            "estimate": self.estimate,
+            "distill": self.distill,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    def save(self, force=True):
+        now = time.monotonic()
+        if not force and now - self.last_write < STATUS_WRITE_INTERVAL:
+            return
+        self.last_write = now
+        self.updated_at = time.time()
+        state = {
+            **self.to_dict(),
+            "params": self.params,
+            "dataset_path": self.dataset_path,
+            "dataset_version": self.dataset_version,
+            "sheet_rows": self.sheet_rows,
+        }
+        tmp_path = f"{self.status_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.status_path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        job = cls(state["job_id"], state["session_id"], state["params"], state["dataset_path"],
+                  state["dataset_version"], state["total_rows"])
+        job.status = state["status"]
+        job.error = state.get("error")
+        job.rows_done = state.get("rows_done", 0)
+        job.sheet_rows = state.get("sheet_rows", 0)
+        job.spreadsheet_id = state.get("spreadsheet_id")
+        job.spreadsheet_url = state.get("spreadsheet_url")
+        job.estimate = state.get("estimate")
+        job.distill = state.get("distill")
+        job.created_at = state.get("created_at", job.created_at)
+        job.updated_at = state.get("updated_at", job.updated_at)
+        return job
+
+    def load_checkpoint(self):
+        """Read the labels checkpointed so far; only needed when the job (re)starts."""
+        self.labels = self._read_checkpoint()
+
+    def discard_checkpoint(self):
+        """Drop a finished job's labels, in memory and on disk."""
+        self.close_checkpoint()
+        self.labels = {}
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    def _read_checkpoint(self):
+        labels = {}
+        try:
+            with open(self.checkpoint_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn last line from a crash
+                    labels[entry["pos"]] = entry["label"]
+        except FileNotFoundError:
+            pass
+        return labels
+
+    # Called by enrichment.enrich_dataset while the job runs
+
+    def cancel_requested(self):
+        return self.cancel_event.is_set()
+
+    def set_sheet(self, spreadsheet_id, spreadsheet_url):
+        with self.lock:
+            self.spreadsheet_id = spreadsheet_id
+            self.spreadsheet_url = spreadsheet_url
+            self.save()
+
+    def set_estimate(self, estimate):
+        with self.lock:
+            self.estimate = estimate
+            self.save()
+
+    def set_distill_metrics(self, metrics):
+        with self.lock:
+            self.distill = metrics
+            self.save()
+
+    def record_labels(self, pairs):
+        if not pairs:
+            return
+        with self.lock:
+            if self.checkpoint is None:
+                self.checkpoint = open(self.checkpoint_path, "a")
+            for pos, label in pairs:
+                self.labels[pos] = label
+                self.checkpoint.write(json.dumps({"pos": pos, "label": label}) + "\n")
+            self.checkpoint.flush()
+
+    def record_progress(self, rows_done=None, sheet_rows=None):
+        with self.lock:
+            if rows_done is not None:
+                self.rows_done = rows_done
+            if sheet_rows is not None:
+                self.sheet_rows = sheet_rows
+            # The sheet offset must be on disk before a resume can trust it
+            self.save(force=sheet_rows is not None)
+
+    def close_checkpoint(self):
+        with self.lock:
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+                self.checkpoint = None
+
+
+class JobManager:
+    """
+    Runs enrichment jobs on a small thread pool and keeps their state on
+    disk. Jobs still queued or running when the process stopped come back
+    as 'interrupted' and resume when their session reconnects, or through
+    the API. A job whose session disconnects is cancelled after
+    JOB_ORPHAN_GRACE_SECONDS unless the session comes back.
+    """
+
+    def __init__(self, workers=ENRICHMENT_JOB_WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.orphan_timers = {}
+        self.stopping = False
+
+    def start(self):
+        os.makedirs(JOBS_FOLDER, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="enrichment")
+        for name in os.listdir(JOBS_FOLDER):
+            if not name.endswith(".json"):
+                continue
+            try:
+                job = EnrichmentJob.load(os.path.join(JOBS_FOLDER, name))
+            except (OSError, KeyError, json.JSONDecodeError) as e:
+                print(f"[jobs] Skipping unreadable job file {name}: {e}", flush=True)
+                continue
+            if job.status in ACTIVE_STATES:
+                job.status = "interrupted"
+                job.save()
+            elif job.status == "completed":
+                job.discard_checkpoint()
+            self.jobs[job.job_id] = job
+        interrupted = sum(job.status == "interrupted" for job in self.jobs.values())
+        print(f"[jobs] Loaded {len(self.jobs)} jobs, {interrupted} interrupted", flush=True)
+
+    def shutdown(self):
+        """Stop running jobs at their next batch; they resume on the next start."""
+        self.stopping = True
+        for timer in list(self.orphan_timers.values()):
+            timer.cancel()
+        with self.lock:
+            for job in self.jobs.values():
+                if job.status == "queued":
+                    job.status = "interrupted"
+                    job.save()
+                if job.status == "running":
+                    job.cancel_event.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, session_id, pd_df, params):
+        """Start enriching a session's dataset; params are enrich_dataset's keyword arguments."""
+        job = EnrichmentJob(
+            uuid.uuid4().hex[:12], session_id, params,
+            datasets.resolve_dataset_path(session_id), datasets.base_version(session_id), len(pd_df),
+        )
+        with self.lock:
+            self.jobs[job.job_id] = job
+            job.save()
+        self.executor.submit(self._run, job, pd_df)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self, session_id=None):
+        jobs = [job for job in self.jobs.values() if session_id is None or job.session_id == session_id]
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            # A running job records its own status once it sees the event;
+            # anything else is cancelled here so nothing resumes it later
+            if job.status not in ("running", "completed"):
+                job.status = "cancelled"
+                job.save()
+            job.cancel_event.set()
+        return job
+
+    def resume(self, job_id, states=RESUMABLE_STATES):
+        """Re-queue a job in one of states (interrupted, cancelled or failed) from its checkpoint."""
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in states:
+            return job
+        if datasets.base_version(job.session_id) != job.dataset_version:
+            with self.lock:
+                job.status = "failed"
+                job.error = "The session's dataset changed since the job started."
+                job.save()
+            return job
+        pd_df = datasets.load_dataset(job.session_id)
+        with self.lock:
+            # It may have been cancelled while the dataset loaded
+            if job.status not in states:
+                return job
+            job.status = "queued"
+            job.error = None
+            job.cancel_event.clear()
+            job.save()
+        self.executor.submit(self._run, job, pd_df)
+        return job
+
+    def session_connected(self, session_id):
+        timer = self.orphan_timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+        for job in self.list(session_id):
+            if job.status == "interrupted":
+                print(f"[jobs] Resuming job {job.job_id} for session {session_id}", flush=True)
+                self.resume(job.job_id, states=("interrupted",))
+
+    def session_disconnected(self, session_id):
+        if not any(job.status in ACTIVE_STATES for job in self.list(session_id)):
+            return
+        timer = threading.Timer(JOB_ORPHAN_GRACE_SECONDS, self._cancel_orphaned, args=(session_id,))
+        timer.daemon = True
+        old = self.orphan_timers.pop(session_id, None)
+        if old is not None:
+            old.cancel()
+        self.orphan_timers[session_id] = timer
+        timer.start()
+
+    def _cancel_orphaned(self, session_id):
+        self.orphan_timers.pop(session_id, None)
+        for job in self.list(session_id):
+            if job.status in ACTIVE_STATES:
+                print(f"[jobs] Session {session_id} is gone, cancelling job {job.job_id}", flush=True)
+                self.cancel(job.job_id)
+
+    def _run(self, job, pd_df):
+        with self.lock:
+            if job.cancel_event.is_set() or self.stopping:
+                if job.status == "queued":
+                    job.status = "interrupted" if self.stopping else "cancelled"
+                    job.save()
+                return
+            job.status = "running"
+            job.run_started = time.monotonic()
+            job.run_start_rows = job.rows_done
+            job.save()
+        try:
+            job.load_checkpoint()
+            result = enrichment.enrich_dataset(pd_df=pd_df, session_id=job.session_id, job=job, **job.params)
+            self._write_back(job, result["dataframe"])
+            status, error = "completed", None
+        except enrichment.EnrichmentCancelled:
+            status, error = ("interrupted" if self.stopping else "cancelled"), None
+        except Exception as e:
+            status, error = "failed", f"{type(e).__name__}: {e}"
+            print(f"[jobs] Job {job.job_id} failed: {error}", flush=True)
+        finally:
+            job.close_checkpoint()
+        with self.lock:
+            job.status = status
+            job.error = error
+            job.save()
+        if status == "completed":
+            # The labels now live in the session dataset and the sheet
+            job.discard_checkpoint()
+        else:
+            # Kept on disk for a resume, which reads them back
+            job.labels = {}
+        print(f"[jobs] Job {job.job_id} {status} ({job.rows_done}/{job.total_rows} rows)", flush=True)
+
+
+    def _write_back(self, job, pd_df):
+        """Append the enriched columns to the session dataset, unless it was replaced meanwhile."""
+        if datasets.base_version(job.session_id) != job.dataset_version:
+            print(f"[jobs] Dataset of session {job.session_id} changed, not writing back job {job.job_id}", flush=True)
+            return
+        col_name = job.params["col_name"]
+        targets = [col_name] if isinstance(col_name, str) else list(col_name)
+        ingest.append_columns(job.session_id, pd_df[targets], source=job.job_id)
+        # Profile the new columns now rather than on the bot's next lookup
+        profiling.get_session_profile(job.session_id)
+
+
+job_manager = JobManager()
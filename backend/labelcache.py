@@ -0,0 +1,71 @@
+# On-disk cache of enrichment labels, shared across runs and sessions
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from datasets import DATA_FOLDER
+
+LABEL_CACHE_PATH = os.getenv("LABEL_CACHE_PATH", os.path.join(DATA_FOLDER, "label_cache.sqlite"))
+
+
+def make_key(model, prompt, schema, context):
+    """Hash of everything that determines a label for one row."""
+    h = hashlib.sha256()
+    for part in (model, prompt, json.dumps(schema, sort_keys=True), context):
+        h.update(part.encode("utf-8", errors="replace"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class LabelCache:
+    """
+    SQLite table of enrichment results by make_key(). Safe to use from
+    several threads; each call runs under one lock on a shared connection.
+    """
+
+    def __init__(self, path=LABEL_CACHE_PATH):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, result TEXT NOT NULL)"
+            )
+        return self.conn
+
+    def get_many(self, keys):
+        """Return {key: result} for the keys that are cached."""
+        found = {}
+        keys = list(keys)
+        with self.lock:
+            conn = self._connect()
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, result FROM labels WHERE key IN ({placeholders})", chunk
+                )
+                for key, result in rows:
+                    found[key] = json.loads(result)
+        return found
+
+    def put_many(self, items):
+        """Store (key, result) pairs, replacing older results."""
+        items = [(key, json.dumps(result)) for key, result in items]
+        if not items:
+            return
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO labels (key, result) VALUES (?, ?)", items)
+
+
+label_cache = LabelCache()
@@ -0,0 +1,230 @@
+# LLM gateway: one pooled async OpenAI client shared by every caller, with retries and metrics
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Calls in flight across the whole process
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "6"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+# Pooled connections, and how long an idle one is kept open
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "60"))
+
+# Latencies kept per tag for the percentiles
+LATENCY_WINDOW = 1000
+
+
+def retry_after_seconds(error):
+    """Server-suggested wait from a 429 response, or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def backoff_seconds(attempt, retry_after=None):
+    """The server's retry-after if given, else jittered exponential backoff."""
+    if retry_after is not None:
+        return retry_after
+    return min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CallMetrics:
+    """Per-tag call counts, token usage and end-to-end latency percentiles."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def _tag(self, tag):
+        if tag not in self.tags:
+            self.tags[tag] = {
+                "calls": 0, "errors": 0, "retries": 0, "rate_limited": 0,
+                "prompt_tokens": 0, "completion_tokens": 0,
+                "latencies": deque(maxlen=self.window),
+            }
+        return self.tags[tag]
+
+    def record(self, tag, latency, usage=None):
+        with self.lock:
+            entry = self._tag(tag)
+            entry["calls"] += 1
+            entry["latencies"].append(latency)
+            if usage is not None:
+                entry["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                entry["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def record_retry(self, tag, rate_limited):
+        with self.lock:
+            entry = self._tag(tag)
+            entry["retries"] += 1
+            entry["rate_limited"] += int(rate_limited)
+
+    def record_error(self, tag):
+        with self.lock:
+            self._tag(tag)["errors"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for tag, entry in self.tags.items():
+                latencies = list(entry["latencies"])
+                p50 = percentile(latencies, 0.5)
+                p99 = percentile(latencies, 0.99)
+                snapshot[tag] = {
+                    **{k: v for k, v in entry.items() if k != "latencies"},
+                    "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                    "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+                }
+            return snapshot
+
+
+class LLMGateway:
+    """
+    Runs every chat completion on one AsyncOpenAI client owned by a
+    dedicated event-loop thread. Callers on the server loop, on an
+    enrichment job's own loop or in plain threads all share its keep-alive
+    connection pool (HTTP/2 through httpx[http2]) and LLM_MAX_CONCURRENCY
+    slots. Connection errors, timeouts, 5xx and 429s are retried with
+    jittered backoff; with a rate limiter, 429s feed it instead.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+        self.metrics = CallMetrics()
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-gateway", daemon=True).start()
+                self.loop = loop
+            return self.loop
+
+    def _client(self):
+        # Only called on the gateway loop, which owns the pool and the semaphore
+        if self.client is None:
+            if not HTTP2_AVAILABLE:
+                print("[llm][WARNING] h2 is not installed, falling back to HTTP/1.1 (install httpx[http2])", flush=True)
+            self.client = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                max_retries=0,
+                timeout=LLM_TIMEOUT_SECONDS,
+                http_client=DefaultAsyncHttpxClient(
+                    http2=HTTP2_AVAILABLE,
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                        keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+                    ),
+                ),
+            )
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.client
+
+    async def chat(self, tag="default", rate_limiter=None, tokens=1, max_retries=LLM_MAX_RETRIES, **kwargs):
+        """
+        client.chat.completions.create(**kwargs) through the gateway, from
+        any event loop. tag groups the call in metrics(); tokens is what the
+        rate limiter is charged per attempt.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._chat(tag, rate_limiter, tokens, max_retries, kwargs), self._ensure_loop()
+        )
+        return await asyncio.wrap_future(future)
+
+    def chat_sync(self, tag="default", rate_limiter=None, tokens=1, max_retries=LLM_MAX_RETRIES, **kwargs):
+        """Blocking chat() for code that is not running on an event loop."""
+        future = asyncio.run_coroutine_threadsafe(
+            self._chat(tag, rate_limiter, tokens, max_retries, kwargs), self._ensure_loop()
+        )
+        return future.result()
+
+    async def _chat(self, tag, rate_limiter, tokens, max_retries, kwargs):
+        client = self._client()
+        started = time.monotonic()
+        for attempt in range(max_retries + 1):
+            # Wait for the budget before taking a slot, so waiting holds none
+            if rate_limiter is not None:
+                await rate_limiter.acquire(tokens)
+            try:
+                async with self.semaphore:
+                    response = await client.chat.completions.create(**kwargs)
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == max_retries:
+                    self.metrics.record_error(tag)
+                    raise
+                rate_limited = isinstance(e, openai.RateLimitError)
+                self.metrics.record_retry(tag, rate_limited)
+                retry_after = retry_after_seconds(e) if rate_limited else None
+                if rate_limited and rate_limiter is not None:
+                    # The limiter slows down and pauses every caller sharing it
+                    rate_limiter.on_rate_limited(retry_after)
+                else:
+                    await asyncio.sleep(backoff_seconds(attempt, retry_after))
+                continue
+            except Exception:
+                self.metrics.record_error(tag)
+                raise
+            if rate_limiter is not None:
+                rate_limiter.on_success()
+            self.metrics.record(tag, time.monotonic() - started, getattr(response, "usage", None))
+            return response
+
+    def stats(self):
+        return {
+            "http2": HTTP2_AVAILABLE,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.max_concurrency - self.semaphore._value if self.semaphore is not None else 0,
+            "calls": self.metrics.snapshot(),
+        }
+
+    def close(self):
+        """Close the pooled connections and stop the gateway loop."""
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        if self.client is not None:
+            asyncio.run_coroutine_threadsafe(self.client.close(), loop).result(timeout=5)
+            self.client = None
+        self.semaphore = None
+        loop.call_soon_threadsafe(loop.stop)
+
+
+gateway = LLMGateway()
@@ -13,9 +13,16 @@ from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
 import os
-import aiofiles
 import report
 import mail
+import datasets
+import ingest
+import profiling
+import sandbox
+import charts
+import results
+import jobs
+import llm
 
 
 from fastapi.staticfiles import StaticFiles
@@ -23,7 +30,7 @@ from fastapi.responses import FileResponse, JSONResponse
 import os
 
 from fastapi import Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from broadcast import broadcaster,enrichment_broadcaster
 
 class SummarizeRequest(BaseModel):
@@ -35,6 +42,10 @@ from pipecat.transports.network.webrtc_connection import IceServer, SmallWebRTCC
 # Load environment variables
 load_dotenv(override=True)
 
+# Process-wide: cached datasets are handed out as shallow copies, which is
+# only safe with pandas copy-on-write (see datasets.DatasetCache)
+datasets.enable_copy_on_write()
+
 DATA_FOLDER = "data"
 os.makedirs(DATA_FOLDER, exist_ok=True)
 
@@ -50,11 +61,16 @@ ice_servers = [
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("App startup...")
+    sandbox.code_pool.start()
+    jobs.job_manager.start()
     yield
     logger.info("App shutdown... Cleaning up WebRTC connections.")
     coros = [pc.disconnect() for pc in pcs_map.values()]
     await asyncio.gather(*coros)
     pcs_map.clear()
+    sandbox.code_pool.shutdown()
+    jobs.job_manager.shutdown()
+    llm.gateway.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -82,6 +98,47 @@ async def enrichment_events(request: Request, session_id: str = None):
             enrichment_broadcaster.remove_listener(queue)
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
+@app.get("/api/llm-metrics")
+async def llm_metrics():
+    """Calls, retries, tokens and p50/p99 latency of LLM calls, by caller."""
+    return llm.gateway.stats()
+
+
+@app.get("/api/enrichment-jobs")
+async def list_enrichment_jobs(session_id: str = None):
+    return {"jobs": [job.to_dict() for job in jobs.job_manager.list(session_id)]}
+
+
+@app.get("/api/enrichment-jobs/{job_id}")
+async def get_enrichment_job(job_id: str):
+    job = jobs.job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
+
+@app.post("/api/enrichment-jobs/{job_id}/cancel")
+async def cancel_enrichment_job(job_id: str):
+    job = jobs.job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
+
+@app.post("/api/enrichment-jobs/{job_id}/resume")
+async def resume_enrichment_job(job_id: str):
+    job = jobs.job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job.status not in jobs.RESUMABLE_STATES:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status} and cannot be resumed.")
+    try:
+        job = await asyncio.to_thread(jobs.job_manager.resume, job_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=410, detail="The job's dataset no longer exists.")
+    return job.to_dict()
+
+
 @app.get("/api/transcript-events")
 async def transcript_events(request: Request):
     """SSE stream for transcript updates."""
@@ -102,23 +159,79 @@ async def transcript_events(request: Request):
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def run_ingest(session_id: str, file_location: str, digest: str, delimiter: str):
+    """Columnar conversion and profiling after the upload response has been sent."""
+    try:
+        ingested = ingest.ingest_csv(file_location, digest=digest, delimiter=delimiter)
+        datasets.invalidate_dataset(session_id)
+    except (FileNotFoundError, ingest.StaleUpload) as e:
+        logger.info(f"Skipping ingest of a superseded upload: {e}")
+        return
+    except Exception as e:
+        logger.warning(f"Columnar ingest failed for {file_location}: {e}")
+        return
+    try:
+        profiling.ensure_profile(ingested["dataframe"], digest)
+    except Exception as e:
+        logger.warning(f"Profiling failed for {file_location}: {e}")
+
+
+def publish_upload(file_location: str, tmp_location: str, schema: dict):
+    """Move a finished upload into place. Blocking; run it in a thread."""
+    with ingest.publish_lock:
+        os.replace(tmp_location, file_location)
+        # Only now that the new CSV is in place, drop the previous upload's
+        # columnar copy and sidecars. The sample-based schema goes in right
+        # away, so the bot never has to parse the file; ingest replaces it
+        # with exact counts.
+        ingest.discard_artifacts(file_location)
+        ingest.write_schema(file_location, schema)
+
+
 @app.post("/api/upload-csv")
-async def upload_csv(session_id: str, file: UploadFile = File(...)):
-    if not file.filename.endswith(".csv"):
-        raise HTTPException(status_code=400, detail="Only CSV files are allowed.")
+async def upload_csv(session_id: str, background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    if not file.filename.endswith(ingest.UPLOAD_SUFFIXES):
+        raise HTTPException(status_code=400, detail="Only CSV files (optionally .gz or .zst compressed) are allowed.")
 
     # Save using session_id instead of original filename
     file_location = os.path.join(DATA_FOLDER, f"{session_id}.csv")
-    
+    tmp_location = f"{file_location}.upload"
+
+    # Stream to disk in bounded chunks, decompressing and inspecting on the fly
+    inspector = ingest.UploadInspector()
     try:
-        async with aiofiles.open(file_location, "wb") as out_file:
-            content = await file.read()
-            await out_file.write(content)
+        writer = await asyncio.to_thread(ingest.UploadWriter, tmp_location, file.filename, inspector)
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(writer.write, chunk)
+            await asyncio.to_thread(writer.close)
+        except BaseException:
+            writer.abort()
+            raise
+        schema = await asyncio.to_thread(inspector.finish)
+        await asyncio.to_thread(publish_upload, file_location, tmp_location, schema)
+    except ingest.DECOMPRESSION_ERRORS as e:
+        raise HTTPException(status_code=400, detail=f"Could not decompress the upload: {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Failed to save file: {e}")
         raise HTTPException(status_code=500, detail="Failed to save file.")
+    finally:
+        if os.path.exists(tmp_location):
+            os.remove(tmp_location)
+
+    # Make sure no session keeps serving the previous upload from memory
+    datasets.invalidate_dataset(session_id)
 
-    return {"success": True, "filename": f"{session_id}.csv"}
+    # Parse once into a memory-mappable columnar copy after responding;
+    # readers fall back to the CSV until it is ready.
+    background_tasks.add_task(run_ingest, session_id, file_location, schema["digest"], schema["delimiter"])
+
+    return {"success": True, "filename": f"{session_id}.csv", "schema": schema}
 
 app.mount("/reports", StaticFiles(directory="reports"), name="reports")
 
@@ -129,7 +242,7 @@ async def report_url(request: SummarizeRequest):
     report_url = f"http://localhost:7860/reports/{pdf_name}"
     summary = await summarize_chat_history(request.session_id, report_url)
     print("summary", summary, flush=True)
-    report.generate_pdf_report(f"data/{request.session_id}.csv", pdf_path, summary)
+    report.generate_pdf_report(request.session_id, pdf_path, summary)
     
     mail.send_mail(
         request.email, 
@@ -139,6 +252,45 @@ async def report_url(request: SummarizeRequest):
     return {"summary": summary, "report_url": report_url}
 
 
+@app.get("/api/profile")
+async def dataset_profile(session_id: str, column: str = None):
+    """Precomputed profile of a session's dataset, or of one of its columns."""
+    profile = profiling.get_session_profile(session_id)
+    if profile is None:
+        if datasets.read_schema(session_id) is None:
+            raise HTTPException(status_code=404, detail="No dataset uploaded for this session.")
+        return JSONResponse(status_code=202, content={"status": "pending"})
+    if column is None:
+        return profile
+    col = profiling.find_column(profile, column)
+    if col is None:
+        raise HTTPException(status_code=404, detail=f"Unknown column: {column}")
+    return col
+
+
+@app.get("/api/images/{name}")
+async def chart_image(name: str):
+    """Stored chart by content hash. The content never changes, so cache it forever."""
+    path = charts.image_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found.")
+    ext = name.rsplit(".", 1)[1]
+    return FileResponse(
+        path,
+        media_type=charts.MEDIA_TYPES[ext],
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
+@app.get("/api/results/{ref}")
+async def full_result(ref: str):
+    """Untruncated text of a tool result that was cut to fit the LLM budget."""
+    text = results.full_result_store.get(ref)
+    if text is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired.")
+    return PlainTextResponse(text)
+
+
 @app.get("/api/test")
 async def test():
     return {"status": "ok"}
@@ -0,0 +1,220 @@
+# Dataset profiles: summary statistics computed once per dataset version
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import datasets
+import ingest
+
+PROFILES_FOLDER = os.path.join(datasets.DATA_FOLDER, "profiles")
+
+TOP_K = 10
+HISTOGRAM_BINS = 20
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+def profile_path(digest):
+    return os.path.join(PROFILES_FOLDER, f"{digest}.json")
+
+
+def _scalar(value):
+    """Make numpy/pandas scalars JSON serializable."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (int, float, bool, str)):
+        return value
+    return str(value)
+
+
+def profile_column(series):
+    non_null = series.dropna()
+    counts = non_null.value_counts()
+    col = {
+        "name": str(series.name),
+        "dtype": str(series.dtype),
+        "count": int(non_null.shape[0]),
+        "null_count": int(series.shape[0] - non_null.shape[0]),
+        "unique": int(counts.shape[0]),
+        "top_values": [
+            {"value": _scalar(value), "count": int(count)}
+            for value, count in counts.head(TOP_K).items()
+        ],
+    }
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        values = non_null.to_numpy(dtype="float64")
+        values = values[np.isfinite(values)]
+        if values.size:
+            quantiles = np.quantile(values, QUANTILES)
+            hist_counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+            col.update({
+                "mean": float(values.mean()),
+                "std": float(values.std(ddof=1)) if values.size > 1 else None,
+                "min": float(values.min()),
+                "max": float(values.max()),
+                "quantiles": {str(q): float(v) for q, v in zip(QUANTILES, quantiles)},
+                "histogram": {"counts": hist_counts.tolist(), "edges": edges.tolist()},
+            })
+    return col
+
+
+def build_profile(df, digest):
+    """Per-column stats, top-k values, quantiles and histograms of a DataFrame."""
+    return {
+        "digest": digest,
+        "row_count": int(df.shape[0]),
+        "column_count": int(df.shape[1]),
+        "columns": [profile_column(df[col]) for col in df.columns],
+    }
+
+
+def load_profile(digest):
+    try:
+        with open(profile_path(digest)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def ensure_profile(df, digest):
+    """
+    Return the stored profile for a dataset version, building and saving it
+    first if this version has not been profiled yet.
+    """
+    profile = load_profile(digest)
+    if profile is not None:
+        return profile
+    profile = build_profile(df, digest)
+    save_profile(profile)
+    print(f"[profiling] Profiled dataset {digest[:12]} ({df.shape[0]} rows)", flush=True)
+    return profile
+
+
+def save_profile(profile):
+    os.makedirs(PROFILES_FOLDER, exist_ok=True)
+    path = profile_path(profile["digest"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f)
+    os.replace(tmp_path, path)
+
+
+def extend_profile(session_id, base_profile, manifest):
+    """
+    Profile of the dataset with its appended columns, stored under the
+    manifest version. Only the appended columns are profiled; the rest is
+    taken from the upload's profile.
+    """
+    profile = load_profile(manifest["version"])
+    if profile is not None:
+        return profile
+    appended = [
+        profile_column(series.rename(name))
+        for name, series in datasets.appended_column_series(session_id, manifest)
+    ]
+    names = {col["name"] for col in appended}
+    columns = [col for col in base_profile["columns"] if col["name"] not in names] + appended
+    profile = {**base_profile, "digest": manifest["version"], "column_count": len(columns), "columns": columns}
+    save_profile(profile)
+    print(f"[profiling] Profiled {len(appended)} appended columns for {manifest['version'][:12]}", flush=True)
+    return profile
+
+
+def get_session_profile(session_id):
+    """
+    Profile of a session's current upload and its appended columns, or
+    None if the upload is not profiled yet.
+    """
+    schema = datasets.read_schema(session_id)
+    if schema is None or not schema.get("digest"):
+        return None
+    profile = load_profile(schema["digest"])
+    manifest = datasets.read_columns_manifest(session_id, schema["digest"])
+    if profile is None or manifest is None or not manifest["entries"]:
+        return profile
+    return extend_profile(session_id, profile, manifest)
+
+
+def profile_for_file(csv_path):
+    """
+    Load a dataset file and its profile, profiling it now if the background
+    stage has not finished (or never ran) for this version.
+    """
+    df = datasets.load_dataset_file(csv_path)
+    schema = datasets.read_schema_file(csv_path)
+    if schema and schema.get("digest"):
+        digest = schema["digest"]
+    else:
+        digest = ingest.hash_file(csv_path)
+    return df, ensure_profile(df, digest)
+
+
+def profile_for_session(session_id):
+    """
+    Load a session's dataset, appended columns included, and its profile,
+    profiling the upload now if the background stage has not finished.
+    """
+    df = datasets.load_dataset(session_id)
+    profile = get_session_profile(session_id)
+    if profile is None:
+        _, profile = profile_for_file(datasets.resolve_dataset_path(session_id))
+        manifest = datasets.read_columns_manifest(session_id, profile["digest"])
+        if manifest is not None and manifest["entries"]:
+            profile = extend_profile(session_id, profile, manifest)
+    return df, profile
+
+
+def find_column(profile, name):
+    for col in profile["columns"]:
+        if col["name"] == name:
+            return col
+    return None
+
+
+def describe_table(profile):
+    """
+    The profile as a DataFrame shaped like df.describe(include='all')
+    transposed, with the column name in the first column.
+    """
+    rows = []
+    for col in profile["columns"]:
+        top = col["top_values"][0] if col["top_values"] else {}
+        quantiles = col.get("quantiles", {})
+        rows.append({
+            "index": col["name"],
+            "count": col["count"],
+            "unique": col["unique"],
+            "top": top.get("value"),
+            "freq": top.get("count"),
+            "mean": col.get("mean"),
+            "std": col.get("std"),
+            "min": col.get("min"),
+            "25%": quantiles.get("0.25"),
+            "50%": quantiles.get("0.5"),
+            "75%": quantiles.get("0.75"),
+            "max": col.get("max"),
+        })
+    return pd.DataFrame(rows)
+
+
+def summarize_for_prompt(profile, max_columns=40):
+    """Compact one-line-per-column summary for the LLM system prompt."""
+    lines = []
+    for col in profile["columns"][:max_columns]:
+        if "mean" in col:
+            q = col["quantiles"]
+            lines.append(
+                f"- {col['name']}: min {col['min']:.4g}, median {q['0.5']:.4g}, "
+                f"mean {col['mean']:.4g}, max {col['max']:.4g}, {col['null_count']} nulls"
+            )
+        else:
+            top = ", ".join(
+                f"{' '.join(str(v['value']).split())[:40]} ({v['count']})" for v in col["top_values"][:3]
+            )
+            lines.append(f"- {col['name']}: {col['unique']} distinct, top: {top}, {col['null_count']} nulls")
+    if len(profile["columns"]) > max_columns:
+        lines.append(f"- ... {len(profile['columns']) - max_columns} more columns")
+    return "\n".join(lines)
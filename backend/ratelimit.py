@@ -0,0 +1,94 @@
+# Client-side rate limiting for LLM calls: token buckets with adaptive backoff
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Async token bucket refilled continuously at `rate` units per second, up
+    to `capacity`. acquire(n) waits until n units are available and takes
+    them. A request larger than the bucket waits for a full bucket and
+    leaves it in debt, so later callers wait that debt off and the rate
+    holds for requests of any size.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # A request larger than the bucket would never fit; it only waits for a full one
+        needed = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.level >= needed:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((needed - self.level) / self.rate)
+
+
+class AdaptiveRateLimiter:
+    """
+    Request and token budgets per minute for one upstream API.
+
+    On a 429 the allowed rate is halved, at most once per cool-down, and
+    every caller pauses for the server's retry-after (or the cool-down);
+    each success then raises it again by a small step, up to the
+    configured limits.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, min_fraction=0.05, recovery_step=0.02, cooldown=1.0):
+        self.max_rpm = requests_per_minute
+        self.max_tpm = tokens_per_minute
+        self.min_fraction = min_fraction
+        self.recovery_step = recovery_step
+        self.cooldown = cooldown
+        self.last_decrease = float("-inf")
+        self.fraction = 1.0
+        self.requests = TokenBucket(requests_per_minute / 60, capacity=max(1, requests_per_minute / 60))
+        self.tokens = TokenBucket(tokens_per_minute / 60, capacity=max(1, tokens_per_minute / 60))
+        self.paused_until = 0.0
+        self.rate_limited = 0
+
+    def _apply_fraction(self):
+        self.requests.rate = self.max_rpm / 60 * self.fraction
+        self.tokens.rate = self.max_tpm / 60 * self.fraction
+
+    async def acquire(self, tokens):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+    def on_success(self):
+        if self.fraction < 1.0:
+            self.fraction = min(1.0, self.fraction + self.recovery_step)
+            self._apply_fraction()
+
+    def on_rate_limited(self, retry_after=None):
+        self.rate_limited += 1
+        now = time.monotonic()
+        # Calls already in flight fail together; treat them as one signal
+        if now - self.last_decrease >= self.cooldown:
+            self.last_decrease = now
+            self.fraction = max(self.min_fraction, self.fraction / 2)
+            self._apply_fraction()
+        pause = retry_after if retry_after is not None else self.cooldown
+        self.paused_until = max(self.paused_until, now + pause)
+
+    def stats(self):
+        return {
+            "requests_per_minute": round(self.max_rpm * self.fraction),
+            "tokens_per_minute": round(self.max_tpm * self.fraction),
+            "rate_limited": self.rate_limited,
+        }
@@ -1,14 +1,12 @@
-import pandas as pd
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import (SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image)
 from reportlab.lib import colors
 from reportlab.lib.units import mm
 import matplotlib.pyplot as plt
-import seaborn as sns
 import io
-import os
 from reportlab.platypus import PageBreak
+import profiling
 
 PAGE_WIDTH, PAGE_HEIGHT = A4
 LEFT_MARGIN = RIGHT_MARGIN = 18 * mm
@@ -65,9 +63,10 @@ def prepare_summary(summary, styles):
     ))
     return Paragraph(summary_with_breaks, styles['SummaryBox'])
 
-def generate_pdf_report(csv_filename, pdf_filename, summary:str):
-    df = pd.read_csv(csv_filename)
-    dataset_name = os.path.basename(csv_filename)
+def generate_pdf_report(session_id, pdf_filename, summary:str):
+    # The session's dataset as the bot sees it, enriched columns included
+    df, profile = profiling.profile_for_session(session_id)
+    dataset_name = f"{session_id}.csv"
     styles = getSampleStyleSheet()
     styles.add(ParagraphStyle(
         name='MyHeading', fontName='Helvetica-Bold', fontSize=16, textColor=colors.HexColor('#07354f'), spaceAfter=10, spaceBefore=8))
@@ -95,14 +94,14 @@ def generate_pdf_report(csv_filename, pdf_filename, summary:str):
 
     # --------- GRAPHS AT THE TOP ---------
     story.append(Paragraph("Key Distributions", styles['MySection']))
-    num_cols = df.select_dtypes(include='number').columns[:3]
+    num_cols = [col for col in profile['columns'] if 'histogram' in col][:3]
     if len(num_cols) == 0:
         story.append(Paragraph("No numerical columns available for plotting.", styles['MyNorm']))
     else:
         for col in num_cols:
-            story.append(Paragraph(f"Distribution of <b>{col}</b>", styles['MyNorm']))
+            story.append(Paragraph(f"Distribution of <b>{col['name']}</b>", styles['MyNorm']))
             plt.figure(figsize=(4, 2))
-            sns.histplot(df[col].dropna(), color="#295773", kde=True)
+            plt.stairs(col['histogram']['counts'], col['histogram']['edges'], fill=True, color="#295773")
             plt.tight_layout()
             buf = io.BytesIO()
             plt.savefig(buf, format='png', bbox_inches='tight')
@@ -127,7 +126,7 @@ def generate_pdf_report(csv_filename, pdf_filename, summary:str):
     story.append(PageBreak())
     # --------- STATISTICS ---------
     story.append(Paragraph("Statistical Summary", styles['MySection']))
-    desc = df.describe(include='all').transpose().reset_index()
+    desc = profiling.describe_table(profile)
     for chunk, start in split_columns(desc, MAX_TABLE_COLS):
         data = [list(chunk.columns)] + chunk.values.tolist()
         col_widths = fit_col_widths(chunk)
@@ -145,7 +144,7 @@ def generate_pdf_report(csv_filename, pdf_filename, summary:str):
     doc.build(story)
 
 if __name__ == '__main__':
-    generate_pdf_report('airline.csv', 'airline_report.pdf', """Dear Team,
+    generate_pdf_report('airline', 'airline_report.pdf', """Dear Team,
 
 Please find below the key insights from the customer satisfaction dataset analysis:
 
@@ -0,0 +1,211 @@
+# Tool-code results: size-budgeted rendering and memoization
+import ast
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "256"))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "256"))
+
+# Budget for a tool result sent to the LLM, SSE listeners and chat history.
+# Roughly four bytes per token.
+TOOL_RESULT_MAX_BYTES = int(os.getenv("TOOL_RESULT_MAX_BYTES", "4000"))
+# Memory for full results kept for the frontend, in megabytes
+FULL_RESULT_STORE_MAX_MB = int(os.getenv("FULL_RESULT_STORE_MAX_MB", "64"))
+
+FULL_RESULT_URL_PREFIX = "/api/results"
+# Rows of a DataFrame or Series kept in its full result
+FULL_RESULT_MAX_ROWS = 1000
+
+
+def result_ref(text):
+    return hashlib.sha256(text.encode("utf-8", errors="replace")).hexdigest()[:32]
+
+
+def truncation_marker(omitted, total, ref):
+    return f"[... truncated {omitted} of {total} bytes, full result: {FULL_RESULT_URL_PREFIX}/{ref} ...]"
+
+
+def truncate_text(text, budget, ref):
+    """Keep the head and tail of text within budget bytes, marking the cut."""
+    data = text.encode("utf-8", errors="replace")
+    if len(data) <= budget:
+        return text
+    marker_budget = len(truncation_marker(len(data), len(data), ref)) + 2
+    room = max(budget - marker_budget, 0)
+    head = data[: room * 2 // 3].decode("utf-8", errors="ignore")
+    tail = data[len(data) - room // 3:].decode("utf-8", errors="ignore") if room // 3 else ""
+    omitted = len(data) - len(head.encode()) - len(tail.encode())
+    return f"{head}\n{truncation_marker(omitted, len(data), ref)}\n{tail}"
+
+
+def summarize_frame(value, rows):
+    """Shape, dtypes and head/tail of a DataFrame or Series."""
+    kind = type(value).__name__
+    if isinstance(value, pd.DataFrame):
+        dtypes = ", ".join(f"{col} {dtype}" for col, dtype in value.dtypes.items())
+    else:
+        dtypes = f"{value.name} {value.dtype}"
+    parts = [f"{kind} shape {value.shape}", f"dtypes: {dtypes}"]
+    if len(value) <= 2 * rows:
+        parts.append(value.to_string())
+    else:
+        parts.append(f"first {rows} rows:\n{value.head(rows).to_string()}")
+        parts.append(f"last {rows} rows:\n{value.tail(rows).to_string()}")
+    return "\n".join(parts)
+
+
+def render_result(value, budget=TOOL_RESULT_MAX_BYTES):
+    """
+    Render a tool result within budget bytes. DataFrames and Series that
+    do not fit are summarized by shape, dtypes and head/tail; long text
+    keeps its head and tail around a marker pointing at the full result.
+
+    Returns (rendered, full_text, ref). full_text is None when nothing was
+    cut, otherwise it is the untruncated text to keep available under ref.
+    """
+    if isinstance(value, pd.DataFrame):
+        full_text = value.to_string(max_rows=FULL_RESULT_MAX_ROWS, show_dimensions=True)
+    elif isinstance(value, pd.Series):
+        full_text = value.to_string(max_rows=FULL_RESULT_MAX_ROWS, length=True, dtype=True, name=True)
+    else:
+        full_text = str(value)
+    if len(full_text.encode("utf-8", errors="replace")) <= budget:
+        return full_text, None, None
+    ref = result_ref(full_text)
+    rendered = full_text
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        for rows in (5, 3, 1):
+            rendered = summarize_frame(value, rows)
+            if len(rendered.encode("utf-8", errors="replace")) <= budget:
+                break
+        rendered = f"{rendered}\n[... summarized, full result: {FULL_RESULT_URL_PREFIX}/{ref} ...]"
+    if len(rendered.encode("utf-8", errors="replace")) > budget:
+        rendered = truncate_text(rendered, budget, ref)
+    return rendered, full_text, ref
+
+
+def normalize_code(code):
+    """
+    Canonical form of a code snippet, so reformatted or re-commented
+    repeats of the same analysis share a cache entry.
+    """
+    try:
+        return ast.unparse(ast.parse(code))
+    except (SyntaxError, ValueError):
+        return "\n".join(line.rstrip() for line in code.strip().splitlines() if line.strip())
+
+
+def entry_size(entry):
+    """Approximate memory held by a cached outcome, in bytes."""
+    size = 0
+    for value in entry.values():
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        elif isinstance(value, pd.DataFrame):
+            size += int(value.memory_usage(index=True, deep=True).sum())
+        elif isinstance(value, list):
+            size += sum(len(item) for item in value if isinstance(item, (str, bytes)))
+    return size
+
+
+class ResultCache:
+    """
+    LRU cache of execute_dataframe_code outcomes, bounded by entry count and
+    total size. Keys cover the dataset version, the normalized code and the
+    call flags, so a new upload never serves stale results.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (outcome, nbytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(dataset_version, code, **flags):
+        h = hashlib.sha256()
+        h.update(str(dataset_version).encode())
+        h.update(b"\0")
+        h.update(normalize_code(code).encode())
+        for name in sorted(flags):
+            h.update(f"\0{name}={flags[name]!r}".encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[0])
+
+    def put(self, key, outcome):
+        nbytes = entry_size(outcome)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (dict(outcome), nbytes)
+            self.total_bytes += nbytes
+            while self.entries and (
+                len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes
+            ):
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+result_cache = ResultCache()
+
+
+class FullResultStore:
+    """Untruncated tool results by reference, bounded by total size (LRU)."""
+
+    def __init__(self, max_bytes=FULL_RESULT_STORE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # ref -> text
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, ref, text):
+        nbytes = len(text)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if ref in self.entries:
+                self.entries.move_to_end(ref)
+                return
+            self.entries[ref] = text
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def get(self, ref):
+        with self.lock:
+            text = self.entries.get(ref)
+            if text is not None:
+                self.entries.move_to_end(ref)
+            return text
+
+
+full_result_store = FullResultStore()
@@ -0,0 +1,510 @@
+# Worker processes that run LLM-written analysis code off the event loop
+import asyncio
+import contextlib
+import io
+import math
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Connection
+
+import pandas as pd
+
+import charts
+import datasets
+import results
+
+try:
+    import resource
+except ImportError:  # Windows: no CPU-time limits
+    resource = None
+
+CODE_WORKERS = int(os.getenv("CODE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Per-call limits. A breach fails the call and the worker is replaced.
+CODE_TIMEOUT_SECONDS = float(os.getenv("CODE_TIMEOUT_SECONDS", "60"))
+CODE_CPU_SECONDS = int(os.getenv("CODE_CPU_SECONDS", "60"))
+CODE_MAX_RSS_MB = int(os.getenv("CODE_MAX_RSS_MB", "2048"))
+# Workers are also replaced after this many calls to shed leaked memory
+CODE_MAX_EXECUTIONS = int(os.getenv("CODE_MAX_EXECUTIONS", "100"))
+# How long a new worker may take to import its modules and report ready
+CODE_WORKER_BOOT_SECONDS = float(os.getenv("CODE_WORKER_BOOT_SECONDS", "60"))
+# Share of CODE_MAX_RSS_MB a worker may spend on its dataset cache
+WORKER_CACHE_FRACTION = 0.25
+
+MEMORY_LIMIT_EXIT_CODE = 86
+
+
+def format_exception(e):
+    return f"{type(e).__name__}: {e}"
+
+
+class WorkerCrashed(Exception):
+    """The worker process died while handling a request."""
+
+
+class CpuLimitExceeded(Exception):
+    """Raised inside tool code when its CPU-time budget runs out."""
+
+
+################ Runs inside the worker processes ################
+
+# PNG bytes of the charts produced by the current call
+_captured_images = []
+_captured_figures = set()
+
+
+def _install_chart_capture():
+    """
+    Redirect Figure.savefig calls that target a file path into memory, so
+    tool code that still saves a chart never touches the filesystem and
+    concurrent sessions cannot overwrite each other's files.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    original_savefig = Figure.savefig
+
+    def savefig(self, fname, *args, **kwargs):
+        if isinstance(fname, (str, os.PathLike)):
+            buf = io.BytesIO()
+            kwargs["format"] = "png"
+            original_savefig(self, buf, *args, **kwargs)
+            _captured_images.append(buf.getvalue())
+            _captured_figures.add(id(self))
+            return None
+        return original_savefig(self, fname, *args, **kwargs)
+
+    Figure.savefig = savefig
+
+
+def _collect_charts():
+    """Render every figure still open after a call, then close them all."""
+    import matplotlib.pyplot as plt
+    for num in plt.get_fignums():
+        fig = plt.figure(num)
+        if id(fig) in _captured_figures:
+            continue
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", bbox_inches="tight")
+        _captured_images.append(buf.getvalue())
+    plt.close("all")
+    images = list(_captured_images)
+    _captured_images.clear()
+    _captured_figures.clear()
+    return images
+
+
+def preload(session_id):
+    """Load a session's dataset into this worker's cache ahead of the first call."""
+    df = datasets.load_dataset(session_id)
+    return df.shape
+
+
+def run_code(session_id, code, upload_to_google_docs=False):
+    """
+    Execute tool code against the session dataset, bound to `df`.
+    Expressions are evaluated and their value returned as text; statements
+    are executed and their printed output returned.
+
+    Returns a dict with the text 'result', rendered within the result budget,
+    whether it is an 'error', every chart drawn as recompressed (bytes,
+    extension) pairs in 'images' and, if requested, the DataFrame to upload
+    to Google Sheets as 'upload'. When the result had to be cut,
+    'full_result' holds the untruncated text and 'result_ref' its reference.
+    """
+    try:
+        df = datasets.load_dataset(session_id)
+    except Exception as e:
+        return {"result": f"Failed to load any dataset: {format_exception(e)}", "upload": None, "error": True, "images": [],
+                "full_result": None, "result_ref": None}
+
+    # Safe dict for local scope
+    safe_locals = {"df": df, "pd": pd}
+    output = io.StringIO()
+    result_to_upload = None
+    error = True
+    value = None
+
+    try:
+        try:
+            compiled = compile(code, "<string>", "eval")
+            try:
+                value = eval(compiled, {}, safe_locals)
+                result = str(value)
+                error = False
+                if upload_to_google_docs and isinstance(value, pd.DataFrame):
+                    result_to_upload = value
+            except Exception as eval_err:
+                result = f"Error during evaluation: {format_exception(eval_err)}"
+                print(result, flush=True)
+        except SyntaxError:
+            before_vars = set(safe_locals.keys())
+            try:
+                with contextlib.redirect_stdout(output):
+                    exec(code, {}, safe_locals)
+                result = output.getvalue() or "Code executed, but did not return or print anything."
+                value = result
+                error = False
+                after_vars = set(safe_locals.keys())
+                if upload_to_google_docs:
+                    new_vars = after_vars - before_vars
+                    df_candidates = [safe_locals[k] for k in new_vars if isinstance(safe_locals[k], pd.DataFrame)]
+                    if not df_candidates:
+                        df_candidates = [
+                            safe_locals[k] for k in after_vars
+                            if isinstance(safe_locals[k], pd.DataFrame) and
+                            (k not in before_vars or id(safe_locals[k]) != id(safe_locals.get(k)))
+                        ]
+                    if df_candidates:
+                        result_to_upload = df_candidates[-1]
+            except Exception as exec_err:
+                tb = traceback.format_exc(limit=3)
+                result = f"Error during execution: {format_exception(exec_err)}\n{tb}"
+                print(result, flush=True)
+    except Exception as e:
+        tb = traceback.format_exc(limit=3)
+        # If something really weird happened
+        result = f"Internal error during code compile step: {format_exception(e)}\n{tb}"
+        print(result, flush=True)
+
+    try:
+        images = [charts.recompress(png) for png in _collect_charts()]
+    except Exception as e:
+        images = []
+        print(f"Error capturing charts: {format_exception(e)}", flush=True)
+
+    # Keep what goes to the LLM within budget; the full text travels by reference
+    result, full_result, ref = results.render_result(result if error else value)
+
+    return {"result": result, "upload": result_to_upload, "error": error, "images": images,
+            "full_result": full_result, "result_ref": ref}
+
+
+TASKS = {
+    "preload": preload,
+    "run_code": run_code,
+}
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    # Peak rather than current RSS: kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+class MemoryWatchdog(threading.Thread):
+    """
+    Samples the worker's RSS while a call runs, tracks its peak and exits
+    the process when the cap is crossed. Exiting is the only reliable stop
+    for code stuck in a large allocation inside pandas or numpy. Between
+    calls the worker is left alone.
+    """
+
+    def __init__(self, max_bytes, interval=0.05):
+        super().__init__(daemon=True)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.peak = 0
+        self.active = False
+
+    def begin(self):
+        self.peak = current_rss() or 0
+        self.active = True
+
+    def end(self):
+        self.active = False
+
+    def run(self):
+        while True:
+            rss = current_rss() if self.active else None
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+                if self.max_bytes and rss > self.max_bytes and self.active:
+                    print(f"[sandbox] RSS {rss >> 20} MB over limit of {self.max_bytes >> 20} MB, exiting", flush=True)
+                    os._exit(MEMORY_LIMIT_EXIT_CODE)
+            time.sleep(self.interval)
+
+
+_cpu_limit_hit = False
+_in_task = False
+
+
+def _on_cpu_limit(signum, frame):
+    global _cpu_limit_hit
+    _cpu_limit_hit = True
+    if _in_task:
+        raise CpuLimitExceeded(f"CPU time limit of {CODE_CPU_SECONDS}s exceeded")
+
+
+def _set_cpu_limit(seconds):
+    """Set the soft RLIMIT_CPU `seconds` of CPU time from now, or lift it."""
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        soft = hard
+    else:
+        soft = math.ceil(time.process_time()) + seconds
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _worker_main(conn):
+    global _cpu_limit_hit, _in_task
+    # Tool code gets shallow copies of cached frames; writes must copy first.
+    # This also gives tool code pandas 3 semantics (no chained assignment).
+    datasets.enable_copy_on_write()
+    # Tool code plots with pyplot; charts are captured in memory
+    _install_chart_capture()
+    # Cached frames count against the RSS cap, so they get a share of it
+    if CODE_MAX_RSS_MB:
+        datasets.dataset_cache.max_bytes = min(
+            datasets.dataset_cache.max_bytes, int(CODE_MAX_RSS_MB * WORKER_CACHE_FRACTION) * 1024 * 1024
+        )
+    watchdog = MemoryWatchdog(CODE_MAX_RSS_MB * 1024 * 1024)
+    watchdog.start()
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    conn.send(("ready", os.getpid(), None))
+    while True:
+        try:
+            task, args = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        _cpu_limit_hit = False
+        watchdog.begin()
+        cpu_start = time.process_time()
+        _set_cpu_limit(CODE_CPU_SECONDS)
+        _in_task = True
+        try:
+            status, payload = "ok", TASKS[task](*args)
+        except Exception as e:
+            status, payload = "error", format_exception(e)
+        finally:
+            _in_task = False
+            watchdog.end()
+            _set_cpu_limit(None)
+        stats = {
+            "cpu_seconds": round(time.process_time() - cpu_start, 3),
+            "peak_memory_mb": round(watchdog.peak / (1024 * 1024), 1),
+            "breach": "cpu" if _cpu_limit_hit else None,
+        }
+        conn.send((status, payload, stats))
+
+
+################ Runs in the server process ################
+
+class CodeWorker:
+    """
+    One worker process and the socket used to talk to it. The worker runs
+    this file as a script, so it imports only what tool code needs rather
+    than the server's entry module and everything behind it.
+    """
+
+    def __init__(self):
+        parent_sock, child_sock = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker", str(child_sock.fileno())],
+            pass_fds=(child_sock.fileno(),),
+        )
+        child_sock.close()
+        self.conn = Connection(parent_sock.detach())
+        self.ready = False
+        self.sessions = set()
+        self.executions = 0
+
+    def wait_ready(self, timeout=CODE_WORKER_BOOT_SECONDS):
+        """Block until the worker has finished booting. Run it in a thread."""
+        if self.ready:
+            return
+        try:
+            if not self.conn.poll(timeout):
+                self.kill()
+                raise WorkerCrashed(f"worker {self.process.pid} did not start within {timeout:g}s")
+            self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise WorkerCrashed(f"worker {self.process.pid} exited while starting: {format_exception(e)}")
+        self.ready = True
+
+    def call(self, task, *args):
+        """
+        Send a task and block until its result arrives. Run it in a thread.
+        Returns (payload, stats).
+        """
+        try:
+            self.conn.send((task, args))
+            status, payload, stats = self.conn.recv()
+        except (EOFError, OSError) as e:
+            try:
+                exitcode = self.process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                exitcode = None
+            if exitcode == MEMORY_LIMIT_EXIT_CODE:
+                raise WorkerCrashed(f"memory limit of {CODE_MAX_RSS_MB} MB exceeded")
+            raise WorkerCrashed(f"worker {self.process.pid} exited: {format_exception(e)}")
+        if status == "error":
+            raise RuntimeError(payload)
+        return payload, stats
+
+    def close(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.conn.close()
+
+
+class CodeWorkerPool:
+    """
+    Fixed-size pool of worker processes for tool code.
+
+    Each worker keeps its own dataset cache, and calls for a session prefer
+    an idle worker that has already loaded that session's dataset. Workers
+    are fresh interpreters, so they never inherit the server's threads or
+    event loop. A worker that breaches a limit is replaced off the event
+    loop, and its slot is only handed out again once the new one is ready.
+    """
+
+    def __init__(self, size=CODE_WORKERS):
+        self.size = size
+        self.idle = []
+        self.slots = None
+        self.replacing = set()
+
+    def start(self):
+        if self.slots is None:
+            self.idle = [CodeWorker() for _ in range(self.size)]
+            self.slots = asyncio.Semaphore(self.size)
+
+    def shutdown(self):
+        for worker in self.idle:
+            worker.close()
+        self.idle = []
+        self.slots = None
+
+    async def _acquire(self, session_id):
+        self.start()
+        await self.slots.acquire()
+        for worker in self.idle:
+            if session_id in worker.sessions:
+                self.idle.remove(worker)
+                return worker
+        # Otherwise take the worker holding the fewest datasets
+        worker = min(self.idle, key=lambda w: len(w.sessions))
+        self.idle.remove(worker)
+        return worker
+
+    def _release(self, worker):
+        self.idle.append(worker)
+        self.slots.release()
+
+    async def _replace(self, worker):
+        """Retire a worker and release its slot once a new one has booted."""
+        await asyncio.to_thread(worker.close)
+        while True:
+            try:
+                worker = await asyncio.to_thread(CodeWorker)
+                await asyncio.to_thread(worker.wait_ready)
+                break
+            except (WorkerCrashed, OSError) as e:
+                print(f"[sandbox] Replacement worker failed to start: {format_exception(e)}", flush=True)
+                await asyncio.sleep(1)
+        if self.slots is None:
+            # The pool shut down meanwhile
+            worker.close()
+            return
+        self._release(worker)
+
+    async def _call(self, session_id, task, *args, timeout=None):
+        worker = await self._acquire(session_id)
+        recycle = False
+        try:
+            # Boot time of a fresh worker does not count against the call
+            await asyncio.to_thread(worker.wait_ready)
+            call = asyncio.to_thread(worker.call, task, session_id, *args)
+            try:
+                payload, stats = await asyncio.wait_for(call, timeout)
+            except asyncio.TimeoutError:
+                recycle = True
+                worker.kill()
+                raise WorkerCrashed(f"time limit of {timeout:g}s exceeded")
+            worker.sessions.add(session_id)
+            worker.executions += 1
+            recycle = stats["breach"] is not None or worker.executions >= CODE_MAX_EXECUTIONS
+            return payload, stats
+        except WorkerCrashed:
+            recycle = True
+            raise
+        except asyncio.CancelledError:
+            # The caller gave up (e.g. the user interrupted the bot), but the
+            # worker is still busy with the call; never hand it out again
+            recycle = True
+            worker.kill()
+            raise
+        finally:
+            if recycle:
+                replacement = asyncio.create_task(self._replace(worker))
+                self.replacing.add(replacement)
+                replacement.add_done_callback(self.replacing.discard)
+            else:
+                self._release(worker)
+
+    async def preload(self, session_id):
+        payload, _ = await self._call(session_id, "preload")
+        return payload
+
+    async def run_code(self, session_id, code, upload_to_google_docs=False):
+        """
+        Run tool code in a worker under the per-call limits. Returns the
+        run_code() dict plus 'cpu_seconds' and 'peak_memory_mb'. A breached
+        limit is reported in 'result' like any other execution error.
+        """
+        start = time.monotonic()
+        try:
+            outcome, stats = await self._call(
+                session_id, "run_code", code, upload_to_google_docs, timeout=CODE_TIMEOUT_SECONDS
+            )
+        except WorkerCrashed as e:
+            outcome = {"result": f"Error during execution: {e}. The worker was restarted.", "upload": None, "error": True, "images": [],
+                "full_result": None, "result_ref": None}
+            stats = {"cpu_seconds": None, "peak_memory_mb": None}
+        outcome["cpu_seconds"] = stats["cpu_seconds"]
+        outcome["peak_memory_mb"] = stats["peak_memory_mb"]
+        print(
+            f"[sandbox] session {session_id}: wall {time.monotonic() - start:.2f}s, "
+            f"cpu {stats['cpu_seconds']}s, peak {stats['peak_memory_mb']} MB",
+            flush=True,
+        )
+        return outcome
+
+
+code_pool = CodeWorkerPool()
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--worker"]:
+    _worker_main(Connection(int(sys.argv[2])))
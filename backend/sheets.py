@@ -1,5 +1,10 @@
 # aci.dev for google sheets integration with fallback gracefull error handling
+import atexit
+import csv
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Try to load dotenv for environment variables (optional)
 try:
@@ -9,8 +14,12 @@ except ImportError:
     pass
 
 # Pandas is always required (for CSV saving)
+import numpy as np
 import pandas as pd
 
+import ingest
+from datasets import PYARROW_AVAILABLE, columnar_path
+
 # Try to use ACI if available and api key present, else fallback to disk
 ACI_AVAILABLE = False
 client = None
@@ -27,6 +36,18 @@ try:
 except Exception as e:
     print(f"ACI not available or failed: {e}")
 
+# Buffered appends: flush after this many rows, bytes or seconds
+SHEETS_FLUSH_ROWS = int(os.getenv("SHEETS_FLUSH_ROWS", "200"))
+SHEETS_FLUSH_BYTES = int(os.getenv("SHEETS_FLUSH_BYTES", str(256 * 1024)))
+SHEETS_FLUSH_SECONDS = float(os.getenv("SHEETS_FLUSH_SECONDS", "2"))
+
+# Uploads: rows and approximate payload bytes per VALUES_UPDATE, and requests in flight
+SHEETS_UPLOAD_CHUNK_ROWS = int(os.getenv("SHEETS_UPLOAD_CHUNK_ROWS", "5000"))
+SHEETS_UPLOAD_CHUNK_BYTES = int(os.getenv("SHEETS_UPLOAD_CHUNK_BYTES", str(2 * 1024 * 1024)))
+SHEETS_UPLOAD_WORKERS = int(os.getenv("SHEETS_UPLOAD_WORKERS", "4"))
+# JSON quoting and separators added to each cell in a request body
+CELL_OVERHEAD_BYTES = 4
+
 def num_to_a1_column(n):
     """Convert zero-based column index to A1 column (A, B... AA, AB...)"""
     s = ''
@@ -36,7 +57,95 @@ def num_to_a1_column(n):
         s = chr(65 + r) + s
     return s
 
-def create_and_upload_df(df, title="New Sheet", sheet_name="Sheet1", linked_account_owner_id="start"):
+def serialize_values(df):
+    """
+    Cell values of df as rows of strings, missing values as ''. Works a
+    column at a time; returns (rows, approximate JSON bytes of each row).
+    """
+    columns = []
+    row_bytes = np.zeros(len(df), dtype=np.int64)
+    for i in range(df.shape[1]):
+        series = df.iloc[:, i]
+        text = list(map(str, series.tolist()))
+        for pos in np.flatnonzero(series.isna().to_numpy()):
+            text[pos] = ""
+        row_bytes += np.fromiter(map(len, text), dtype=np.int64, count=len(text)) + CELL_OVERHEAD_BYTES
+        columns.append(text)
+    rows = [list(row) for row in zip(*columns)] if columns else [[] for _ in range(len(df))]
+    return rows, row_bytes
+
+
+def chunk_rows(row_bytes, max_rows=SHEETS_UPLOAD_CHUNK_ROWS, max_bytes=SHEETS_UPLOAD_CHUNK_BYTES):
+    """Split rows into [start, end) chunks of at most max_rows rows and, past one row, max_bytes."""
+    chunks = []
+    cumulative = np.cumsum(row_bytes)
+    start = 0
+    while start < len(row_bytes):
+        before = cumulative[start - 1] if start else 0
+        end = int(np.searchsorted(cumulative, before + max_bytes, side="right"))
+        end = min(max(end, start + 1), start + max_rows, len(row_bytes))
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def update_values(spreadsheet_id, range_a1, values, linked_account_owner_id="start"):
+    return client.functions.execute(
+        function_name="GOOGLE_SHEETS__VALUES_UPDATE",
+        function_arguments={
+            "path": {"spreadsheetId": spreadsheet_id, "range": range_a1},
+            "query": {"valueInputOption": "RAW"},
+            "body": {
+                "range": range_a1,
+                "majorDimension": "ROWS",
+                "values": values
+            }
+        },
+        linked_account_owner_id=linked_account_owner_id
+    )
+
+
+def upload_rows(spreadsheet_id, sheet_name, df, last_col, linked_account_owner_id="start", on_progress=None):
+    """
+    Write df's rows below the header, one VALUES_UPDATE per chunk and up
+    to SHEETS_UPLOAD_WORKERS at a time. Calls on_progress(rows_done,
+    total_rows) as chunks land. Raises the first failed chunk's error.
+    """
+    if df.empty:
+        return
+    started = time.monotonic()
+    rows, row_bytes = serialize_values(df)
+    chunks = chunk_rows(row_bytes)
+    lock = threading.Lock()
+    done = [0]
+
+    def upload(chunk):
+        start, end = chunk
+        # Row 1 is the header
+        range_a1 = f"{sheet_name}!A{start + 2}:{last_col}{end + 1}"
+        update_values(spreadsheet_id, range_a1, rows[start:end], linked_account_owner_id)
+        with lock:
+            done[0] += end - start
+            rows_done = done[0]
+        if on_progress is not None:
+            on_progress(rows_done, len(rows))
+
+    with ThreadPoolExecutor(max_workers=SHEETS_UPLOAD_WORKERS, thread_name_prefix="sheets-upload") as pool:
+        for future in [pool.submit(upload, chunk) for chunk in chunks]:
+            future.result()
+    print(f"[create_and_upload_df] Uploaded {len(rows)} rows in {len(chunks)} requests "
+          f"in {time.monotonic() - started:.1f}s", flush=True)
+
+
+def create_and_upload_df(df, title="New Sheet", sheet_name="Sheet1", linked_account_owner_id="start",
+                         on_progress=None, wait=True):
+    """
+    Create a spreadsheet holding df. The spreadsheet and its header row are
+    created first; data rows follow in chunks (see upload_rows), and
+    on_progress(rows_done, total_rows) reports how far they got. With
+    wait=False the rows are uploaded on a background thread and this
+    returns as soon as the spreadsheet exists.
+    """
     print(f"[create_and_upload_df] DataFrame shape: {df.shape}", flush=True)
     if ACI_AVAILABLE:
         # Step 1: Create spreadsheet
@@ -60,32 +169,27 @@ def create_and_upload_df(df, title="New Sheet", sheet_name="Sheet1", linked_acco
             )
             spreadsheet_id = create_result.data["spreadsheetId"]
             spreadsheet_url = create_result.data.get("spreadsheetUrl", None)
-            # Step 2: Values
-            values = [list(map(str, df.columns))]
-            for _, row in df.iterrows():
-                values.append([("" if pd.isna(x) else str(x)) for x in row])
-            # Step 3: Range
-            last_col = num_to_a1_column(len(df.columns) - 1)
-            last_row = len(df) + 1
-            range_a1 = f"{sheet_name}!A1:{last_col}{last_row}"
-            # Step 4: Update
-            update_result = client.functions.execute(
-                function_name="GOOGLE_SHEETS__VALUES_UPDATE",
-                function_arguments={
-                    "path": {"spreadsheetId": spreadsheet_id, "range": range_a1},
-                    "query": {"valueInputOption": "RAW"},
-                    "body": {
-                        "range": range_a1,
-                        "majorDimension": "ROWS",
-                        "values": values
-                    }
-                },
-                linked_account_owner_id=linked_account_owner_id
+            # Step 2: Header
+            last_col = num_to_a1_column(max(len(df.columns), 1) - 1)
+            update_result = update_values(
+                spreadsheet_id, f"{sheet_name}!A1:{last_col}1", [list(map(str, df.columns))], linked_account_owner_id
             )
+            # Step 3: Rows, in chunks
+            upload_args = (spreadsheet_id, sheet_name, df, last_col, linked_account_owner_id, on_progress)
+            if wait:
+                upload_rows(*upload_args)
+            elif not df.empty:
+                def upload_in_background():
+                    try:
+                        upload_rows(*upload_args)
+                    except Exception as e:
+                        print(f"ACI error while uploading rows to {spreadsheet_id}: {e}", flush=True)
+                threading.Thread(target=upload_in_background, name="sheets-upload", daemon=True).start()
             return {
                 "spreadsheetId": spreadsheet_id,
                 "spreadsheetUrl": spreadsheet_url,
                 "updateResult": update_result,
+                "uploading": not wait and not df.empty,
                 "mock": False
             }
         except Exception as e:
@@ -93,10 +197,15 @@ def create_and_upload_df(df, title="New Sheet", sheet_name="Sheet1", linked_acco
 
     # Fallback: save as CSV
     fname = f"{title.replace(' ', '_')}.csv"
-    df.to_csv(fname, index=False)
+    local_sheets.create(fname, df)
     print(f"[DISK] Saved DataFrame as CSV: {os.path.abspath(fname)}")
+    if on_progress is not None:
+        on_progress(len(df), len(df))
     return {
+        "spreadsheetId": os.path.abspath(fname),
+        "spreadsheetUrl": None,
         "filename": os.path.abspath(fname),
+        "uploading": False,
         "mock": True,
         "message": f"Saved dataframe as CSV to {os.path.abspath(fname)}"
     }
@@ -136,30 +245,178 @@ def append_rows_to_sheet(spreadsheet_id, sheet_name, rows, linked_account_owner_
     filename = spreadsheet_id
     if not filename.endswith(".csv"):
         filename = f"{filename}.csv"
-    df_new = pd.DataFrame(rows)
-    if os.path.exists(filename):
-        # Load, find columns count, match structure, and append
-        df_existing = pd.read_csv(filename)
-        if df_existing.shape[1] == df_new.shape[1]:
-            df_result = pd.concat([df_existing, df_new], ignore_index=True)
-        else:
-            print("[DISK][WARNING] Shape mismatch on append, will save side-by-side.")
-            df_new.columns = [f"col_{i}" for i in range(df_new.shape[1])]
-            df_result = pd.concat([df_existing, df_new], ignore_index=True)
-        df_result.to_csv(filename, index=False)
-        print(f"[DISK] Appended to existing CSV: {os.path.abspath(filename)}")
-        return {
-            "filename": os.path.abspath(filename),
-            "mock": True,
-            "message": f"Appended rows to {os.path.abspath(filename)}"
-        }
-    else:
-        # New file; save headers as col_1,...
-        df_new.columns = [f"col_{i}" for i in range(df_new.shape[1])]
-        df_new.to_csv(filename, index=False)
-        print(f"[DISK] Created new CSV: {os.path.abspath(filename)}")
-        return {
-            "filename": os.path.abspath(filename),
-            "mock": True,
-            "message": f"Created new CSV {os.path.abspath(filename)}"
-        }
+    created = local_sheets.append(filename, rows)
+    action = "Created new CSV" if created else "Appended rows to"
+    return {
+        "filename": os.path.abspath(filename),
+        "mock": True,
+        "message": f"{action} {os.path.abspath(filename)}"
+    }
+
+class LocalSheets:
+    """
+    Append-only CSV files standing in for Google Sheets when ACI is not
+    available. Each file keeps an open handle and rows are streamed with
+    csv.writer, so an append costs only the rows written. close() writes
+    a columnar copy next to the CSV for fast reads, when pyarrow is there.
+    """
+
+    def __init__(self):
+        self.handles = {}  # abspath -> (file, csv writer, column count)
+        self.lock = threading.Lock()
+
+    def create(self, filename, df):
+        path = os.path.abspath(filename)
+        with self.lock:
+            self._close(path, write_columnar=False)
+            self._discard_columnar(path)
+            df.to_csv(path, index=False)
+
+    def append(self, filename, rows):
+        """Append rows, creating the file with col_N headers if needed. Returns True if created."""
+        path = os.path.abspath(filename)
+        with self.lock:
+            created = False
+            if path not in self.handles:
+                created = not os.path.exists(path)
+                self._discard_columnar(path)
+                f = open(path, "a", newline="")
+                writer = csv.writer(f)
+                if created:
+                    width = max((len(row) for row in rows), default=0)
+                    writer.writerow([f"col_{i}" for i in range(width)])
+                else:
+                    width = self._header_width(path)
+                self.handles[path] = (f, writer, width)
+            f, writer, width = self.handles[path]
+            if any(len(row) != width for row in rows):
+                print(f"[DISK][WARNING] Row width does not match the {width} columns of {path}", flush=True)
+            writer.writerows(rows)
+            f.flush()
+        return created
+
+    def close(self, filename):
+        with self.lock:
+            self._close(os.path.abspath(filename), write_columnar=True)
+
+    def close_all(self):
+        with self.lock:
+            for path in list(self.handles):
+                self._close(path, write_columnar=False)
+
+    def _close(self, path, write_columnar):
+        entry = self.handles.pop(path, None)
+        if entry is None:
+            return
+        entry[0].close()
+        if write_columnar and PYARROW_AVAILABLE:
+            try:
+                ingest.write_columnar(pd.read_csv(path), columnar_path(path))
+            except Exception as e:
+                print(f"[DISK] Could not write columnar copy of {path}: {e}", flush=True)
+
+    @staticmethod
+    def _discard_columnar(path):
+        # Appends make an existing columnar copy stale
+        try:
+            os.remove(columnar_path(path))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _header_width(path):
+        with open(path, newline="") as f:
+            return len(next(csv.reader(f), []))
+
+
+local_sheets = LocalSheets()
+atexit.register(local_sheets.close_all)
+
+
+class BufferedSheetWriter:
+    """
+    Write-behind buffer for append_rows_to_sheet. Rows are sent in one
+    append once the buffer holds max_rows rows or max_bytes of cell text,
+    or its oldest row has waited max_seconds, so the sheet keeps filling
+    up without one request per row. Rows are always appended in the order
+    they were written.
+
+    Use as a context manager, or call close(), so the remainder is flushed
+    on completion and on failure. on_flush(rows_written) is called after
+    each append that reached the sheet.
+    """
+
+    def __init__(self, spreadsheet_id, sheet_name, max_rows=SHEETS_FLUSH_ROWS, max_bytes=SHEETS_FLUSH_BYTES,
+                 max_seconds=SHEETS_FLUSH_SECONDS, linked_account_owner_id="start", on_flush=None):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.linked_account_owner_id = linked_account_owner_id
+        self.on_flush = on_flush
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.oldest = None
+        self.lock = threading.Lock()        # guards the buffer
+        self.flush_lock = threading.Lock()  # keeps appends in order
+        self.closed = threading.Event()
+        self.calls = 0
+        self.rows_written = 0
+        self.timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.timer.start()
+
+    def write(self, rows):
+        with self.lock:
+            if self.closed.is_set():
+                raise RuntimeError("BufferedSheetWriter is closed")
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.extend(rows)
+            self.buffer_bytes += sum(len(cell) for row in rows for cell in row)
+            full = len(self.buffer) >= self.max_rows or self.buffer_bytes >= self.max_bytes
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                rows = self.buffer
+                self.buffer = []
+                self.buffer_bytes = 0
+                self.oldest = None
+            if not rows:
+                return
+            append_rows_to_sheet(self.spreadsheet_id, self.sheet_name, rows,
+                                 linked_account_owner_id=self.linked_account_owner_id)
+            self.calls += 1
+            self.rows_written += len(rows)
+            if self.on_flush is not None:
+                self.on_flush(self.rows_written)
+
+    def close(self):
+        self.closed.set()
+        self.timer.join()
+        try:
+            self.flush()
+        finally:
+            # No-op unless appends went to the disk fallback
+            local_sheets.close(self.spreadsheet_id if self.spreadsheet_id.endswith(".csv")
+                               else f"{self.spreadsheet_id}.csv")
+        print(f"[sheets] {self.rows_written} rows appended in {self.calls} requests", flush=True)
+
+    def _flush_periodically(self):
+        while not self.closed.wait(min(self.max_seconds, 0.5)):
+            with self.lock:
+                due = self.oldest is not None and time.monotonic() - self.oldest >= self.max_seconds
+            if due:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"[sheets] Timed flush failed: {e}", flush=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,6 @@
+# Tests import the backend modules the way main.py does, from the backend folder
+import os
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
@@ -0,0 +1,66 @@
+import gzip
+
+import pytest
+
+import ingest
+
+
+def inspect(data, chunk_size=7):
+    inspector = ingest.UploadInspector()
+    for i in range(0, len(data), chunk_size):
+        inspector.feed(data[i:i + chunk_size])
+    return inspector.finish()
+
+
+def test_inspector_does_not_count_quoted_newlines():
+    data = b'id,note\n1,"first\nline"\n2,"a\n\nb"\n3,plain\n'
+    schema = inspect(data)
+    assert schema["row_count"] == 3
+    assert [c["name"] for c in schema["columns"]] == ["id", "note"]
+
+
+def test_inspector_counts_last_record_without_newline():
+    assert inspect(b"a,b\n1,2\n3,4")["row_count"] == 2
+
+
+def test_inspector_sniffs_delimiter():
+    schema = inspect(b"a;b;c\n1;2;3\n4;5;6\n")
+    assert schema["delimiter"] == ";"
+    assert [c["name"] for c in schema["columns"]] == ["a", "b", "c"]
+    assert schema["row_count"] == 2
+
+
+def write_upload(tmp_path, data, filename, chunk_size=5):
+    inspector = ingest.UploadInspector()
+    writer = ingest.UploadWriter(tmp_path / "upload.csv", filename, inspector)
+    try:
+        for i in range(0, len(data), chunk_size):
+            writer.write(data[i:i + chunk_size])
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return inspector.finish()
+
+
+def test_writer_decompresses_every_gzip_member(tmp_path):
+    data = gzip.compress(b"a,b\n1,2\n") + gzip.compress(b"3,4\n") + gzip.compress(b"5,6\n")
+    schema = write_upload(tmp_path, data, "upload.csv.gz")
+    assert (tmp_path / "upload.csv").read_bytes() == b"a,b\n1,2\n3,4\n5,6\n"
+    assert schema["row_count"] == 3
+
+
+def test_writer_decompresses_in_bounded_steps(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "DECOMPRESS_STEP_BYTES", 64)
+    fed = []
+    monkeypatch.setattr(ingest.UploadInspector, "feed", lambda self, chunk: fed.append(len(chunk)))
+    body = b"a,b\n" + b"1,2\n" * 1000
+    write_upload(tmp_path, gzip.compress(body), "upload.csv.gz", chunk_size=len(body))
+    assert sum(fed) == len(body)
+    assert max(fed) <= 64
+
+
+def test_writer_rejects_truncated_gzip(tmp_path):
+    data = gzip.compress(b"a,b\n" + b"1,2\n" * 100)
+    with pytest.raises(ValueError):
+        write_upload(tmp_path, data[:-10], "upload.csv.gz")
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+import ratelimit
+
+
+class FakeClock:
+    """Stands in for time.monotonic and asyncio.sleep, so budgets are checked without waiting."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.real_sleep = asyncio.sleep
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+        await self.real_sleep(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def run_calls(acquire, amounts):
+    async def main():
+        for amount in amounts:
+            await acquire(amount)
+    asyncio.run(main())
+
+
+def test_bucket_waits_for_small_requests(clock):
+    bucket = ratelimit.TokenBucket(rate=10, capacity=10)
+    run_calls(bucket.acquire, [5] * 6)
+    # 30 units at 10/s with 10 available up front
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_bucket_charges_requests_larger_than_capacity_in_full(clock):
+    bucket = ratelimit.TokenBucket(rate=100, capacity=100)
+    run_calls(bucket.acquire, [450] * 10)
+    # The last call may start once all but its own 450 are paid off
+    assert clock.now >= (450 * 9 - 100) / 100
+
+
+def test_limiter_holds_tokens_per_minute_for_large_calls(clock):
+    tokens_per_minute = 6000
+    limiter = ratelimit.AdaptiveRateLimiter(requests_per_minute=100000, tokens_per_minute=tokens_per_minute)
+    # Every call is five times the bucket, which holds one second of budget
+    amounts = [500] * 60
+    run_calls(limiter.acquire, amounts)
+    # Whatever has been charged by the last call's start, minus the up-front bucket, took a minute per budget
+    charged_before_last = sum(amounts[:-1]) - tokens_per_minute / 60
+    assert clock.now >= charged_before_last / tokens_per_minute * 60
+    assert sum(amounts) / (clock.now / 60) <= tokens_per_minute * 1.2
+
+
+def test_limiter_halves_rate_on_429_and_recovers(clock):
+    limiter = ratelimit.AdaptiveRateLimiter(requests_per_minute=600, tokens_per_minute=60000, cooldown=1.0)
+    limiter.on_rate_limited(retry_after=2.0)
+    limiter.on_rate_limited()  # same burst, ignored for the rate
+    assert limiter.stats()["requests_per_minute"] == 300
+    assert limiter.paused_until == pytest.approx(2.0)
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.stats()["requests_per_minute"] == 600
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+import sandbox
+
+SESSION = "test-session"
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    # Workers inherit the working directory, and with it the data folder
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / f"{SESSION}.csv").write_text("a,b\n1,2\n3,4\n")
+    monkeypatch.chdir(tmp_path)
+    pool = sandbox.CodeWorkerPool(size=1)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+async def settle(pool):
+    """Wait until every recycled worker has been replaced."""
+    while pool.replacing:
+        await asyncio.gather(*pool.replacing)
+
+
+def test_cancelled_call_recycles_worker(pool):
+    first = pool.idle[0]
+
+    async def main():
+        busy = asyncio.create_task(pool.run_code(SESSION, "import time\ntime.sleep(30)"))
+        await asyncio.sleep(2)
+        busy.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await busy
+        await settle(pool)
+        return await pool.run_code(SESSION, "df['a'].sum()")
+
+    outcome = asyncio.run(main())
+    assert first.process.returncode is not None
+    assert pool.idle[0] is not first
+    # The next call gets its own result, not the one of the cancelled call
+    assert outcome["error"] is False
+    assert outcome["result"] == "4"
+
+
+def test_timed_out_call_recycles_worker(pool, monkeypatch):
+    monkeypatch.setattr(sandbox, "CODE_TIMEOUT_SECONDS", 2)
+    first = pool.idle[0]
+
+    async def main():
+        outcome = await pool.run_code(SESSION, "import time\ntime.sleep(30)")
+        await settle(pool)
+        return outcome, await pool.run_code(SESSION, "len(df)")
+
+    timed_out, outcome = asyncio.run(main())
+    assert timed_out["error"] is True
+    assert "time limit" in timed_out["result"]
+    assert first.process.returncode is not None
+    assert pool.idle[0] is not first
+    assert outcome["result"] == "2"
@@ -2,6 +2,7 @@ import React, { useEffect, useState, useCallback, useRef } from 'react'
 import { RotateCcw, Download, Database } from 'lucide-react'
 import { Button } from '@/components/ui/button'
 import AgentProgressView from './BackgroundAgent'
+import { getBackendUrl } from '@/lib/config'
 
 type MsgRole = 'user' | 'assistant' | 'data' | 'code' | 'image'
 
@@ -30,6 +31,11 @@ function parseLinesToMessages(lines: string[]) {
     return messages;
 }
 
+// "image:" messages carry either a backend path (/api/images/...) or legacy base64 PNG data
+function imageSrc(content: string) {
+    return content.startsWith('/') ? `${getBackendUrl()}${content}` : `data:image/png;base64,${content}`
+}
+
 function renderWithLineBreaksFromString(text: string) {
     return text.split('\\n').map((line, idx, arr) =>
         idx < arr.length - 1 ? [line, <br key={idx} />] : line
@@ -230,7 +236,7 @@ export default function TranscriptView({
                         }}
                     >
                         <img
-                            src={`data:image/png;base64,${base64}`}
+                            src={imageSrc(base64)}
                             alt="Result graph"
                             className="max-h-[260px] max-w-full rounded shadow-lg"
                             draggable={false}
@@ -259,7 +265,7 @@ export default function TranscriptView({
                                     }}
                                 >
                                     <img
-                                        src={`data:image/png;base64,${base64}`}
+                                        src={imageSrc(base64)}
                                         alt="Expanded result graph"
                                         className="rounded-lg shadow-lg"
                                         style={{
@@ -296,7 +302,7 @@ export default function TranscriptView({
                     role="button"
                 >
                     <img
-                        src={`data:image/png;base64,${base64}`}
+                        src={imageSrc(base64)}
                         alt="Result graph"
                         className="max-h-[260px] max-w-full rounded shadow-lg"
                         draggable={false}
@@ -326,7 +332,7 @@ export default function TranscriptView({
                                 onClick={e => e.stopPropagation()}
                             >
                                 <img
-                                    src={`data:image/png;base64,${base64}`}
+                                    src={imageSrc(base64)}
                                     alt="Expanded result graph"
                                     className="rounded-lg shadow-lg"
                                     style={{